@@ -1,25 +1,56 @@
-﻿from flask import Flask, render_template, request, jsonify, session, redirect, url_for, flash
-import sqlite3
+﻿from flask import Flask, Response, render_template, request, session, redirect, url_for, flash
+from flask.json import JSONEncoder
 import os
 from datetime import datetime, timedelta
+from urllib.parse import quote
 import random
 import string
+import json
+import cache
+import database
+import exams
+import exports
+import fastjson
+import feed
+import gradebook
+import grading
+import jobs
+import polling
+import rendering
+import similarity
+import submissions
+import unread
+from fastjson import jsonify
 
 app = Flask(__name__)
 app.secret_key = 'school_system_secret_key_2024'
-app.config['TEMPLATES_AUTO_RELOAD'] = True
+# وضع القوالب (تطوير/إنتاج) وتخزين الأجزاء المعروضة
+rendering.configure(app)
 app.config['PERMANENT_SESSION_LIFETIME'] = timedelta(hours=24)
 app.config['SESSION_REFRESH_EACH_REQUEST'] = True
 
+# ترميز صفوف قاعدة البيانات في jsonify
+class AppJSONEncoder(JSONEncoder):
+    def default(self, o):
+        try:
+            return fastjson.default(o)
+        except TypeError:
+            return super().default(o)
+
+app.json_encoder = AppJSONEncoder
+
 # إنشاء مجلدات التخزين
 if not os.path.exists('data'):
     os.makedirs('data')
 
 # تهيئة قاعدة البيانات
 def init_db():
-    conn = sqlite3.connect('data/database.db')
+    conn = database.connect()
     c = conn.cursor()
     
+    # إعدادات خاصة بنوع قاعدة البيانات (مثل WAL في SQLite)
+    database.setup(conn)
+    
     # جدول المستخدمين
     c.execute('''CREATE TABLE IF NOT EXISTS users
                  (id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -91,12 +122,43 @@ def init_db():
                   submitted_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                   graded_at TIMESTAMP)''')
     
+    # جداول الاختبارات
+    exams.init_exam_tables(c)
+    
+    # جداول إحصائيات الدرجات
+    gradebook.init_gradebook_tables(c)
+    
+    # جدول أحداث المستخدمين
+    feed.init_feed_tables(c)
+    
+    # مؤشرات القراءة في غرف الدردشة
+    unread.init_unread_tables(c)
+    
+    # فهرس قائمة التصحيح
+    grading.init_grading_tables(c)
+    
+    # جدول المهام في الخلفية
+    jobs.init_job_tables(c)
+    
+    # سجل التغييرات لإبطال الذاكرة المؤقتة بين العمال
+    cache.init_cache_tables(c)
+    
+    # نصوص الحلول الطويلة المضغوطة
+    submissions.init_submission_tables(c)
+    
+    # تواقيع الحلول لكشف التشابه
+    similarity.init_similarity_tables(c)
+    
     # إنشاء مستخدم المدير إذا لم يكن موجوداً
-    c.execute('''INSERT OR IGNORE INTO users (name, username, password, user_type) 
-                 VALUES (?, ?, ?, ?)''', 
+    c.execute('''INSERT INTO users (name, username, password, user_type) 
+                 VALUES (?, ?, ?, ?) ON CONFLICT DO NOTHING''', 
               ('مدير النظام', 'admin', 'admin123', 'admin'))
     
     conn.commit()
+    
+    # حساب إحصائيات الواجبات الموجودة مسبقاً
+    gradebook.rebuild_all_stats(conn)
+    
     conn.close()
 
 # دوال مساعدة
@@ -104,7 +166,7 @@ def generate_room_code():
     return ''.join(random.choices(string.ascii_uppercase + string.digits, k=6))
 
 def get_user_stats(user_id, user_type):
-    conn = sqlite3.connect('data/database.db')
+    conn = database.connect()
     c = conn.cursor()
     stats = {}
     
@@ -136,19 +198,19 @@ def get_user_stats(user_id, user_type):
         c.execute('SELECT COUNT(*) FROM assignments WHERE teacher_id = ?', (user_id,))
         stats['assignments_count'] = c.fetchone()[0]
         
-        c.execute('SELECT COUNT(*) FROM users WHERE user_type = "student"')
+        c.execute("SELECT COUNT(*) FROM users WHERE user_type = 'student'")
         stats['students_count'] = c.fetchone()[0]
         
         c.execute('''SELECT COUNT(*) FROM assignment_submissions s
                      JOIN assignments a ON s.assignment_id = a.id
-                     WHERE a.teacher_id = ? AND s.status = "submitted"''', (user_id,))
+                     WHERE a.teacher_id = ? AND s.status = 'submitted' ''', (user_id,))
         stats['pending_grading'] = c.fetchone()[0]
     
     elif user_type == 'admin':
-        c.execute('SELECT COUNT(*) FROM users WHERE user_type = "student"')
+        c.execute("SELECT COUNT(*) FROM users WHERE user_type = 'student'")
         stats['students_count'] = c.fetchone()[0]
         
-        c.execute('SELECT COUNT(*) FROM users WHERE user_type = "teacher"')
+        c.execute("SELECT COUNT(*) FROM users WHERE user_type = 'teacher'")
         stats['teachers_count'] = c.fetchone()[0]
         
         c.execute('SELECT COUNT(*) FROM rooms WHERE is_active = 1')
@@ -160,6 +222,19 @@ def get_user_stats(user_id, user_type):
     conn.close()
     return stats
 
+# عدّ الطلبات الجارية لتقدير حمل الخادم
+@app.before_request
+def before_request():
+    polling.request_started()
+    # حذف القيم التي غيرها عامل آخر؛ الملفات الثابتة والعناوين غير الموجودة لا تقرأ الذاكرة
+    if request.endpoint not in (None, 'static'):
+        cache.sync()
+
+@app.teardown_request
+def teardown_request(exception):
+    polling.request_finished()
+    database.close_db()
+
 # إضافة رؤوس HTTP لمنع التخزين المؤقت
 @app.after_request
 def after_request(response):
@@ -181,25 +256,26 @@ def login():
     password = request.form['password']
     user_type = request.form['user_type']
     
-    conn = sqlite3.connect('data/database.db')
+    conn = database.connect()
     c = conn.cursor()
     
-    c.execute('''SELECT * FROM users WHERE username = ? AND password = ? 
+    c.execute('''SELECT id, name, username, user_type, grade, section FROM users
+                 WHERE username = ? AND password = ? 
                  AND user_type = ? AND is_active = 1''', (username, password, user_type))
-    user = c.fetchone()
+    user = database.fetch_one(c)
     conn.close()
     
     if user:
         session.permanent = True
-        session['user_id'] = user[0]
-        session['username'] = user[2]
-        session['user_type'] = user[4]
-        session['name'] = user[1]
-        session['grade'] = user[5]
-        session['section'] = user[6]
+        session['user_id'] = user.id
+        session['username'] = user.username
+        session['user_type'] = user.user_type
+        session['name'] = user.name
+        session['grade'] = user.grade
+        session['section'] = user.section
         session.modified = True
         
-        flash(f'مرحباً بعودتك، {user[1]}!', 'success')
+        flash(f'مرحباً بعودتك، {user.name}!', 'success')
         
         if user_type == 'student':
             return redirect('/student/dashboard')
@@ -222,7 +298,7 @@ def register():
     section = request.form.get('section', '')
     subject = request.form.get('subject', '')
     
-    conn = sqlite3.connect('data/database.db')
+    conn = database.connect()
     c = conn.cursor()
     
     try:
@@ -232,7 +308,7 @@ def register():
         conn.commit()
         session.modified = True
         flash('تم إنشاء الحساب بنجاح! يمكنك الآن تسجيل الدخول.', 'success')
-    except sqlite3.IntegrityError:
+    except database.IntegrityError:
         flash('اسم المستخدم موجود مسبقاً!', 'error')
     finally:
         conn.close()
@@ -249,7 +325,7 @@ def student_dashboard():
     session.modified = True
     stats = get_user_stats(session['user_id'], 'student')
     
-    conn = sqlite3.connect('data/database.db')
+    conn = database.connect()
     c = conn.cursor()
     
     # الغرف الدراسية
@@ -257,13 +333,18 @@ def student_dashboard():
                  JOIN room_students rs ON r.id = rs.room_id
                  JOIN users u ON r.teacher_id = u.id
                  WHERE rs.student_id = ? AND r.is_active = 1''', (session['user_id'],))
-    rooms = [dict(zip([col[0] for col in c.description], row)) for row in c.fetchall()]
+    rooms = database.fetch_all(c)
+    
+    # آخر الأحداث
+    feed_items, feed_cursor = feed.get_feed(conn, session['user_id'])
     
     conn.close()
     
     return render_template('student_dashboard.html',
                          stats=stats,
                          rooms=rooms,
+                         feed_items=feed_items,
+                         feed_cursor=feed_cursor,
                          session=session)
 
 @app.route('/student/rooms')
@@ -273,15 +354,16 @@ def student_rooms():
         return redirect('/')
     
     session.modified = True
-    conn = sqlite3.connect('data/database.db')
+    conn = database.connect()
     c = conn.cursor()
     
-    # غرف الطالب
-    c.execute('''SELECT r.*, u.name as teacher_name FROM rooms r
+    # غرف الطالب مع عدد الرسائل غير المقروءة
+    c.execute('''SELECT r.*, u.name as teacher_name, %s as unread_count FROM rooms r
                  JOIN room_students rs ON r.id = rs.room_id
                  JOIN users u ON r.teacher_id = u.id
-                 WHERE rs.student_id = ? AND r.is_active = 1''', (session['user_id'],))
-    rooms = [dict(zip([col[0] for col in c.description], row)) for row in c.fetchall()]
+                 WHERE rs.student_id = ? AND r.is_active = 1''' % unread.UNREAD_COUNT_SQL,
+              (session['user_id'], session['user_id'], session['user_id']))
+    rooms = database.fetch_all(c)
     
     # غرف متاحة
     c.execute('''SELECT r.*, u.name as teacher_name FROM rooms r
@@ -289,7 +371,7 @@ def student_rooms():
                  WHERE r.grade = ? AND r.section = ? AND r.is_active = 1
                  AND r.id NOT IN (SELECT room_id FROM room_students WHERE student_id = ?)''',
               (session['grade'], session['section'], session['user_id']))
-    available_rooms = [dict(zip([col[0] for col in c.description], row)) for row in c.fetchall()]
+    available_rooms = database.fetch_all(c)
     
     conn.close()
     
@@ -305,35 +387,26 @@ def student_assignments():
         return redirect('/')
     
     session.modified = True
-    conn = sqlite3.connect('data/database.db')
+    conn = database.connect()
     c = conn.cursor()
     
-    c.execute('''SELECT a.*, u.name as teacher_name FROM assignments a
+    # حالة التسليم في نفس الاستعلام بدلاً من استعلام لكل واجب
+    c.execute('''SELECT a.*, u.name as teacher_name,
+                 COALESCE(s.status, 'not_submitted') as submission_status,
+                 s.grade as submission_grade, s.feedback
+                 FROM assignments a
                  JOIN users u ON a.teacher_id = u.id
+                 LEFT JOIN assignment_submissions s ON s.assignment_id = a.id AND s.student_id = ?
                  WHERE a.grade = ? AND a.section = ?
-                 ORDER BY a.due_date''', (session['grade'], session['section']))
-    assignments = [dict(zip([col[0] for col in c.description], row)) for row in c.fetchall()]
-    
-    # إضافة حالة التسليم
-    for assignment in assignments:
-        c.execute('''SELECT status, grade, feedback FROM assignment_submissions 
-                     WHERE assignment_id = ? AND student_id = ?''',
-                  (assignment['id'], session['user_id']))
-        submission = c.fetchone()
-        if submission:
-            assignment['submission_status'] = submission[0]
-            assignment['submission_grade'] = submission[1]
-            assignment['feedback'] = submission[2]
-        else:
-            assignment['submission_status'] = 'not_submitted'
-            assignment['submission_grade'] = None
-            assignment['feedback'] = None
+                 ORDER BY a.due_date''', (session['user_id'], session['grade'], session['section']))
+    assignments = database.fetch_all(c)
     
     conn.close()
     
     return render_template('student_assignments.html',
                          assignments=assignments,
-                         session=session)
+                         session=session,
+                         today=datetime.now().strftime('%Y-%m-%d'))
 
 @app.route('/student/room/<int:room_id>')
 def student_room_chat(room_id):
@@ -342,7 +415,7 @@ def student_room_chat(room_id):
         return redirect('/')
     
     session.modified = True
-    conn = sqlite3.connect('data/database.db')
+    conn = database.connect()
     c = conn.cursor()
     
     # التحقق من أن الطالب مسجل في الغرفة
@@ -351,26 +424,27 @@ def student_room_chat(room_id):
                  JOIN users u ON r.teacher_id = u.id
                  WHERE r.id = ? AND rs.student_id = ? AND r.is_active = 1''',
               (room_id, session['user_id']))
-    room = c.fetchone()
+    room = database.fetch_one(c)
     
     if not room:
         conn.close()
         flash('غير مسموح لك بالدخول إلى هذه الغرفة!', 'error')
         return redirect('/student/rooms')
     
-    room_dict = dict(zip([col[0] for col in c.description], room))
-    
     # جلب رسائل الدردشة
     c.execute('''SELECT cm.*, u.user_type FROM chat_messages cm
                  JOIN users u ON cm.user_id = u.id
                  WHERE cm.room_id = ? ORDER BY cm.sent_at DESC LIMIT 50''', (room_id,))
-    messages = [dict(zip([col[0] for col in c.description], row)) for row in c.fetchall()]
+    messages = database.fetch_all(c)
     messages.reverse()  # لعرض الرسائل من الأقدم إلى الأحدث
     
+    if messages:
+        unread.mark_read(conn, session['user_id'], room_id, messages[-1].id)
+    
     conn.close()
     
     return render_template('student_room_chat.html',
-                         room=room_dict,
+                         room=room,
                          messages=messages,
                          session=session)
 
@@ -384,18 +458,23 @@ def teacher_dashboard():
     session.modified = True
     stats = get_user_stats(session['user_id'], 'teacher')
     
-    conn = sqlite3.connect('data/database.db')
+    conn = database.connect()
     c = conn.cursor()
     
     # الغرف النشطة
     c.execute('SELECT * FROM rooms WHERE teacher_id = ? AND is_active = 1', (session['user_id'],))
-    rooms = [dict(zip([col[0] for col in c.description], row)) for row in c.fetchall()]
+    rooms = database.fetch_all(c)
+    
+    # آخر الأحداث
+    feed_items, feed_cursor = feed.get_feed(conn, session['user_id'])
     
     conn.close()
     
     return render_template('teacher_dashboard.html',
                          stats=stats,
                          rooms=rooms,
+                         feed_items=feed_items,
+                         feed_cursor=feed_cursor,
                          session=session)
 
 @app.route('/teacher/rooms')
@@ -405,14 +484,15 @@ def teacher_rooms():
         return redirect('/')
     
     session.modified = True
-    conn = sqlite3.connect('data/database.db')
+    conn = database.connect()
     c = conn.cursor()
     
     c.execute('''SELECT r.*, 
-                 (SELECT COUNT(*) FROM room_students WHERE room_id = r.id) as student_count
-                 FROM rooms r WHERE teacher_id = ? ORDER BY created_at DESC''',
-              (session['user_id'],))
-    rooms = [dict(zip([col[0] for col in c.description], row)) for row in c.fetchall()]
+                 (SELECT COUNT(*) FROM room_students WHERE room_id = r.id) as student_count,
+                 %s as unread_count
+                 FROM rooms r WHERE teacher_id = ? ORDER BY created_at DESC''' % unread.UNREAD_COUNT_SQL,
+              (session['user_id'], session['user_id'], session['user_id']))
+    rooms = database.fetch_all(c)
     
     conn.close()
     
@@ -427,15 +507,15 @@ def teacher_assignments():
         return redirect('/')
     
     session.modified = True
-    conn = sqlite3.connect('data/database.db')
+    conn = database.connect()
     c = conn.cursor()
     
     c.execute('''SELECT a.*,
                  (SELECT COUNT(*) FROM assignment_submissions WHERE assignment_id = a.id) as submissions_count,
-                 (SELECT COUNT(*) FROM assignment_submissions WHERE assignment_id = a.id AND status = "graded") as graded_count
+                 (SELECT COUNT(*) FROM assignment_submissions WHERE assignment_id = a.id AND status = 'graded') as graded_count
                  FROM assignments a WHERE teacher_id = ? ORDER BY created_at DESC''',
               (session['user_id'],))
-    assignments = [dict(zip([col[0] for col in c.description], row)) for row in c.fetchall()]
+    assignments = database.fetch_all(c)
     
     conn.close()
     
@@ -451,32 +531,35 @@ def teacher_assignment_submissions(assignment_id):
         return redirect('/')
     
     session.modified = True
-    conn = sqlite3.connect('data/database.db')
+    conn = database.connect()
     c = conn.cursor()
     
     # التحقق من أن المعلم صاحب الواجب
     c.execute('SELECT * FROM assignments WHERE id = ? AND teacher_id = ?', (assignment_id, session['user_id']))
-    assignment = c.fetchone()
+    assignment = database.fetch_one(c)
     
     if not assignment:
         conn.close()
         flash('غير مسموح لك بالوصول إلى هذا الواجب!', 'error')
         return redirect('/teacher/assignments')
     
-    assignment_dict = dict(zip([col[0] for col in c.description], assignment))
+    # حلول الطلاب: معاينة فقط، والنص الكامل يُجلب عند فتحه
+    assignment_submissions = submissions.list_for_assignment(conn, assignment_id)
+    
+    # إحصائيات الواجب المحسوبة مسبقاً
+    stats = gradebook.get_assignment_stats(conn, assignment_id)
     
-    # جلب حلول الطلاب
-    c.execute('''SELECT s.*, u.name as student_name, u.grade, u.section 
-                 FROM assignment_submissions s
-                 JOIN users u ON s.student_id = u.id
-                 WHERE s.assignment_id = ? ORDER BY s.submitted_at DESC''', (assignment_id,))
-    submissions = [dict(zip([col[0] for col in c.description], row)) for row in c.fetchall()]
+    # الحلول المتشابهة (تُفهرس الحلول القديمة مرة واحدة عند أول عرض)
+    similarity.index_missing(conn, assignment_id)
+    similar_pairs = similarity.similar_pairs_report(conn, assignment_id)
     
     conn.close()
     
     return render_template('teacher_assignment_submissions.html',
-                         assignment=assignment_dict,
-                         submissions=submissions,
+                         assignment=assignment,
+                         submissions=assignment_submissions,
+                         stats=stats,
+                         similar_pairs=similar_pairs,
                          session=session)
 
 @app.route('/teacher/students')
@@ -486,11 +569,11 @@ def teacher_students():
         return redirect('/')
     
     session.modified = True
-    conn = sqlite3.connect('data/database.db')
+    conn = database.connect()
     c = conn.cursor()
     
-    c.execute('SELECT * FROM users WHERE user_type = "student" ORDER BY grade, section, name')
-    students = [dict(zip([col[0] for col in c.description], row)) for row in c.fetchall()]
+    c.execute("SELECT * FROM users WHERE user_type = 'student' ORDER BY grade, section, name")
+    students = database.fetch_all(c)
     
     conn.close()
     
@@ -505,39 +588,40 @@ def teacher_room_chat(room_id):
         return redirect('/')
     
     session.modified = True
-    conn = sqlite3.connect('data/database.db')
+    conn = database.connect()
     c = conn.cursor()
     
     # التحقق من أن المعلم صاحب الغرفة
     c.execute('''SELECT r.* FROM rooms r
                  WHERE r.id = ? AND r.teacher_id = ? AND r.is_active = 1''',
               (room_id, session['user_id']))
-    room = c.fetchone()
+    room = database.fetch_one(c)
     
     if not room:
         conn.close()
         flash('غير مسموح لك بالدخول إلى هذه الغرفة!', 'error')
         return redirect('/teacher/rooms')
     
-    room_dict = dict(zip([col[0] for col in c.description], room))
-    
-    # جلب الطلاب في الغرفة
-    c.execute('''SELECT u.id, u.name, u.grade, u.section FROM users u
+    # طلاب الغرفة (يتغيرون فقط عند الانضمام)
+    students = cache.get_or_load(cache.ROOM, room_id, 'students', lambda: database.query_all(
+        conn, '''SELECT u.id, u.name, u.grade, u.section FROM users u
                  JOIN room_students rs ON u.id = rs.student_id
-                 WHERE rs.room_id = ? AND u.is_active = 1''', (room_id,))
-    students = [dict(zip([col[0] for col in c.description], row)) for row in c.fetchall()]
+                 WHERE rs.room_id = ? AND u.is_active = 1''', (room_id,)))
     
     # جلب رسائل الدردشة
     c.execute('''SELECT cm.*, u.user_type FROM chat_messages cm
                  JOIN users u ON cm.user_id = u.id
                  WHERE cm.room_id = ? ORDER BY cm.sent_at DESC LIMIT 50''', (room_id,))
-    messages = [dict(zip([col[0] for col in c.description], row)) for row in c.fetchall()]
+    messages = database.fetch_all(c)
     messages.reverse()  # لعرض الرسائل من الأقدم إلى الأحدث
     
+    if messages:
+        unread.mark_read(conn, session['user_id'], room_id, messages[-1].id)
+    
     conn.close()
     
     return render_template('teacher_room_chat.html',
-                         room=room_dict,
+                         room=room,
                          students=students,
                          messages=messages,
                          session=session)
@@ -552,18 +636,18 @@ def admin_dashboard():
     session.modified = True
     stats = get_user_stats(session['user_id'], 'admin')
     
-    conn = sqlite3.connect('data/database.db')
+    conn = database.connect()
     c = conn.cursor()
     
     # آخر المستخدمين
-    c.execute('SELECT * FROM users WHERE user_type != "admin" ORDER BY created_at DESC LIMIT 10')
-    recent_users = [dict(zip([col[0] for col in c.description], row)) for row in c.fetchall()]
+    c.execute("SELECT * FROM users WHERE user_type != 'admin' ORDER BY created_at DESC LIMIT 10")
+    recent_users = database.fetch_all(c)
     
     # آخر الغرف
     c.execute('''SELECT r.*, u.name as teacher_name FROM rooms r
                  JOIN users u ON r.teacher_id = u.id
                  ORDER BY r.created_at DESC LIMIT 5''')
-    recent_rooms = [dict(zip([col[0] for col in c.description], row)) for row in c.fetchall()]
+    recent_rooms = database.fetch_all(c)
     
     conn.close()
     
@@ -580,11 +664,11 @@ def admin_users():
         return redirect('/')
     
     session.modified = True
-    conn = sqlite3.connect('data/database.db')
+    conn = database.connect()
     c = conn.cursor()
     
-    c.execute('SELECT * FROM users WHERE user_type != "admin" ORDER BY user_type, name')
-    users = [dict(zip([col[0] for col in c.description], row)) for row in c.fetchall()]
+    c.execute("SELECT * FROM users WHERE user_type != 'admin' ORDER BY user_type, name")
+    users = database.fetch_all(c)
     
     conn.close()
     
@@ -604,11 +688,11 @@ def api_create_room():
     section = request.form['section']
     description = request.form.get('description', '')
     
+    conn = database.connect()
+    c = conn.cursor()
+    
     try:
         code = generate_room_code()
-        conn = sqlite3.connect('data/database.db')
-        c = conn.cursor()
-        
         c.execute('''INSERT INTO rooms (name, subject, grade, section, code, teacher_id, description)
                      VALUES (?, ?, ?, ?, ?, ?, ?)''',
                   (name, subject, grade, section, code, session['user_id'], description))
@@ -618,6 +702,7 @@ def api_create_room():
         
         return jsonify({'success': True, 'code': code})
     except Exception as e:
+        conn.close()
         return jsonify({'success': False, 'error': str(e)})
 
 @app.route('/api/join_room', methods=['POST'])
@@ -627,28 +712,34 @@ def api_join_room():
     
     room_code = request.form['room_code']
     
-    conn = sqlite3.connect('data/database.db')
+    conn = database.connect()
     c = conn.cursor()
     
-    c.execute('SELECT * FROM rooms WHERE code = ? AND is_active = 1', (room_code,))
-    room = c.fetchone()
+    c.execute('SELECT id, name, teacher_id FROM rooms WHERE code = ? AND is_active = 1', (room_code,))
+    room = database.fetch_one(c)
     
     if not room:
         conn.close()
         return jsonify({'success': False, 'error': 'رمز الغرفة غير صحيح'})
     
     # التحقق من التسجيل المسبق
-    c.execute('SELECT * FROM room_students WHERE room_id = ? AND student_id = ?', (room[0], session['user_id']))
+    c.execute('SELECT * FROM room_students WHERE room_id = ? AND student_id = ?', (room.id, session['user_id']))
     if c.fetchone():
         conn.close()
         return jsonify({'success': False, 'error': 'أنت مسجل في هذه الغرفة مسبقاً'})
     
     try:
-        c.execute('INSERT INTO room_students (room_id, student_id) VALUES (?, ?)', (room[0], session['user_id']))
+        c.execute('INSERT INTO room_students (room_id, student_id) VALUES (?, ?)', (room.id, session['user_id']))
+        feed.publish(c, [session['user_id']], feed.ROOM_JOINED,
+                     f'انضممت إلى غرفة {room.name}', link=f'/student/room/{room.id}')
+        feed.publish(c, [room.teacher_id], feed.ROOM_JOINED,
+                     f'انضم {session["name"]} إلى غرفة {room.name}', link=f'/teacher/room/{room.id}')
+        cache.changed(c, cache.ROOM, room.id)
+        cache.changed(c, cache.USER, session['user_id'])
         conn.commit()
         session.modified = True
         conn.close()
-        return jsonify({'success': True, 'room_name': room[1]})
+        return jsonify({'success': True, 'room_name': room.name})
     except Exception as e:
         conn.close()
         return jsonify({'success': False, 'error': str(e)})
@@ -661,11 +752,11 @@ def api_send_message():
     room_id = request.form['room_id']
     message = request.form['message']
     
-    conn = sqlite3.connect('data/database.db')
+    conn = database.connect()
     c = conn.cursor()
     
     try:
-        c.execute('''INSERT INTO chat_messages (room_id, user_id, user_name, message)
+        message_id = database.insert(c, '''INSERT INTO chat_messages (room_id, user_id, user_name, message)
                      VALUES (?, ?, ?, ?)''',
                   (room_id, session['user_id'], session['name'], message))
         conn.commit()
@@ -673,15 +764,14 @@ def api_send_message():
         # جلب الرسالة الجديدة مع معلومات المستخدم
         c.execute('''SELECT cm.*, u.user_type FROM chat_messages cm
                      JOIN users u ON cm.user_id = u.id
-                     WHERE cm.id = last_insert_rowid()''')
-        new_message = c.fetchone()
+                     WHERE cm.id = ?''', (message_id,))
+        new_message = database.fetch_one(c)
         
         session.modified = True
         conn.close()
         
         if new_message:
-            message_dict = dict(zip([col[0] for col in c.description], new_message))
-            return jsonify({'success': True, 'message': message_dict})
+            return jsonify({'success': True, 'message': new_message})
         else:
             return jsonify({'success': True})
             
@@ -690,6 +780,7 @@ def api_send_message():
         return jsonify({'success': False, 'error': str(e)})
 
 @app.route('/api/get_messages/<int:room_id>')
+@polling.polling_endpoint
 def api_get_messages(room_id):
     if 'user_id' not in session:
         return jsonify({'success': False, 'error': 'غير مصرح'})
@@ -697,19 +788,40 @@ def api_get_messages(room_id):
     # إضافة timestamp لمنع التخزين المؤقت
     timestamp = request.args.get('t', '')
     
-    conn = sqlite3.connect('data/database.db')
+    conn = database.connect()
     c = conn.cursor()
     
     c.execute('''SELECT cm.*, u.user_type FROM chat_messages cm
                  JOIN users u ON cm.user_id = u.id
                  WHERE cm.room_id = ? ORDER BY cm.sent_at DESC LIMIT 50''', (room_id,))
-    messages = [dict(zip([col[0] for col in c.description], row)) for row in c.fetchall()]
+    messages = database.fetch_all(c)
     messages.reverse()  # لإرجاع الرسائل من الأقدم إلى الأحدث
     
+    # الغرفة الهادئة تستطلع أبطأ
+    idle = polling.seconds_since(messages[-1].sent_at) if messages else None
+    
+    # الرسائل المعروضة أصبحت مقروءة (الكتابة فقط عند وصول رسائل جديدة)
+    if messages:
+        unread.mark_read(conn, session['user_id'], room_id, messages[-1].id)
+    
     session.modified = True
     conn.close()
     
-    return jsonify({'success': True, 'messages': messages})
+    return jsonify({'success': True, 'messages': messages,
+                    'next_poll_ms': polling.next_poll_ms(3000, idle)})
+
+@app.route('/api/unread_counts')
+@polling.polling_endpoint
+def api_unread_counts():
+    if 'user_id' not in session or session['user_type'] not in ('student', 'teacher'):
+        return jsonify({'success': False, 'error': 'غير مصرح'})
+    
+    conn = database.connect()
+    counts = unread.unread_counts(conn, session['user_id'], session['user_type'])
+    conn.close()
+    
+    return jsonify({'success': True, 'counts': counts,
+                    'next_poll_ms': polling.next_poll_ms(30000)})
 
 @app.route('/api/create_assignment', methods=['POST'])
 def api_create_assignment():
@@ -724,20 +836,29 @@ def api_create_assignment():
     due_date = request.form['due_date']
     total_marks = int(request.form['total_marks'])
     
+    conn = database.connect()
+    c = conn.cursor()
+    
     try:
-        conn = sqlite3.connect('data/database.db')
-        c = conn.cursor()
-        
-        c.execute('''INSERT INTO assignments 
+        assignment_id = database.insert(c, '''INSERT INTO assignments 
                     (title, description, subject, grade, section, teacher_id, due_date, total_marks)
                      VALUES (?, ?, ?, ?, ?, ?, ?, ?)''',
                   (title, description, subject, grade, section, session['user_id'], due_date, total_marks))
+        
+        # إشعار كل طلاب الصف بإدخال واحد
+        feed.publish_to_grade(c, grade, section, feed.NEW_ASSIGNMENT,
+                              f'واجب جديد: {title}', f'{subject} - موعد التسليم {due_date}',
+                              '/student/assignments')
+        cache.changed(c, cache.ASSIGNMENT, assignment_id)
+        cache.changed(c, cache.CLASS, f'{grade}/{section}')
+        cache.changed(c, cache.USER, session['user_id'])
         conn.commit()
         session.modified = True
         conn.close()
         
         return jsonify({'success': True})
     except Exception as e:
+        conn.close()
         return jsonify({'success': False, 'error': str(e)})
 
 @app.route('/api/submit_assignment', methods=['POST'])
@@ -748,19 +869,29 @@ def api_submit_assignment():
     assignment_id = request.form['assignment_id']
     solution = request.form['solution']
     
-    conn = sqlite3.connect('data/database.db')
+    conn = database.connect()
     c = conn.cursor()
     
     # التحقق من التسليم المسبق
-    c.execute('SELECT * FROM assignment_submissions WHERE assignment_id = ? AND student_id = ?',
+    c.execute('SELECT id FROM assignment_submissions WHERE assignment_id = ? AND student_id = ?',
               (assignment_id, session['user_id']))
     if c.fetchone():
         conn.close()
         return jsonify({'success': False, 'error': 'لقد قمت بتسليم هذا الواجب مسبقاً'})
     
     try:
-        c.execute('''INSERT INTO assignment_submissions (assignment_id, student_id, solution)
-                     VALUES (?, ?, ?)''', (assignment_id, session['user_id'], solution))
+        submission_id = submissions.create(c, assignment_id, session['user_id'], solution)
+        similarity.index_submission(c, submission_id, int(assignment_id), solution)
+        
+        c.execute('SELECT teacher_id, title FROM assignments WHERE id = ?', (assignment_id,))
+        assignment = database.fetch_one(c)
+        if assignment:
+            feed.publish(c, [assignment.teacher_id], feed.NEW_SUBMISSION,
+                         f'حل جديد: {assignment.title}', session['name'],
+                         f'/teacher/assignment/{assignment_id}')
+            cache.changed(c, cache.USER, assignment.teacher_id)
+        cache.changed(c, cache.ASSIGNMENT, assignment_id)
+        cache.changed(c, cache.USER, session['user_id'])
         conn.commit()
         session.modified = True
         conn.close()
@@ -769,6 +900,21 @@ def api_submit_assignment():
         conn.close()
         return jsonify({'success': False, 'error': str(e)})
 
+@app.route('/api/submission/<int:submission_id>')
+def api_get_submission(submission_id):
+    if 'user_id' not in session:
+        return jsonify({'success': False, 'error': 'غير مصرح'})
+    
+    conn = database.connect()
+    submission = submissions.get(conn, submission_id)
+    conn.close()
+    
+    # المعلم صاحب الواجب أو الطالب صاحب الحل فقط
+    if not submission or session['user_id'] not in (submission['teacher_id'], submission['student_id']):
+        return jsonify({'success': False, 'error': 'الحل غير موجود'})
+    
+    return jsonify({'success': True, 'submission': submission})
+
 @app.route('/api/grade_submission', methods=['POST'])
 def api_grade_submission():
     if 'user_id' not in session or session['user_type'] != 'teacher':
@@ -778,32 +924,42 @@ def api_grade_submission():
     grade = int(request.form['grade'])
     feedback = request.form.get('feedback', '')
     
+    conn = database.connect()
+    c = conn.cursor()
+    
     try:
-        conn = sqlite3.connect('data/database.db')
-        c = conn.cursor()
-        
         # التحقق من أن المعلم صاحب الواجب
-        c.execute('''SELECT a.teacher_id FROM assignments a
+        c.execute('''SELECT a.teacher_id, a.id, a.title, a.total_marks, s.student_id FROM assignments a
                      JOIN assignment_submissions s ON a.id = s.assignment_id
                      WHERE s.id = ?''', (submission_id,))
-        result = c.fetchone()
+        result = database.fetch_one(c)
         
-        if not result or result[0] != session['user_id']:
+        if not result or result.teacher_id != session['user_id']:
             conn.close()
             return jsonify({'success': False, 'error': 'غير مصرح لك بتصحيح هذا الحل'})
         
         c.execute('''UPDATE assignment_submissions 
-                     SET grade = ?, feedback = ?, status = "graded", graded_at = CURRENT_TIMESTAMP
+                     SET grade = ?, feedback = ?, status = 'graded', graded_at = CURRENT_TIMESTAMP
                      WHERE id = ?''', (grade, feedback, submission_id))
+        feed.publish(c, [result.student_id], feed.GRADE_POSTED,
+                     f'تم تصحيح: {result.title}', f'الدرجة: {grade}/{result.total_marks}',
+                     '/student/assignments')
+        cache.changed(c, cache.USER, result.student_id)
+        cache.changed(c, cache.USER, session['user_id'])
         conn.commit()
+        
+        # تحديث إحصائيات هذا الواجب فقط (يسجل تغيير الواجب بعد كتابة الإحصائيات)
+        gradebook.refresh_assignment_stats(conn, result.id)
         session.modified = True
         conn.close()
         
         return jsonify({'success': True})
     except Exception as e:
+        conn.close()
         return jsonify({'success': False, 'error': str(e)})
 
 @app.route('/api/get_student_assignments')
+@polling.polling_endpoint
 def api_get_student_assignments():
     if 'user_id' not in session or session['user_type'] != 'student':
         return jsonify({'success': False, 'error': 'غير مصرح'})
@@ -811,36 +967,28 @@ def api_get_student_assignments():
     # إضافة timestamp لمنع التخزين المؤقت
     timestamp = request.args.get('t', '')
     
-    conn = sqlite3.connect('data/database.db')
+    conn = database.connect()
     c = conn.cursor()
     
-    c.execute('''SELECT a.*, u.name as teacher_name FROM assignments a
+    # حالة التسليم في نفس الاستعلام بدلاً من استعلام لكل واجب
+    c.execute('''SELECT a.*, u.name as teacher_name,
+                 COALESCE(s.status, 'not_submitted') as submission_status,
+                 s.grade as submission_grade, s.feedback
+                 FROM assignments a
                  JOIN users u ON a.teacher_id = u.id
+                 LEFT JOIN assignment_submissions s ON s.assignment_id = a.id AND s.student_id = ?
                  WHERE a.grade = ? AND a.section = ?
-                 ORDER BY a.due_date''', (session['grade'], session['section']))
-    assignments = [dict(zip([col[0] for col in c.description], row)) for row in c.fetchall()]
-    
-    # إضافة حالة التسليم
-    for assignment in assignments:
-        c.execute('''SELECT status, grade, feedback FROM assignment_submissions 
-                     WHERE assignment_id = ? AND student_id = ?''',
-                  (assignment['id'], session['user_id']))
-        submission = c.fetchone()
-        if submission:
-            assignment['submission_status'] = submission[0]
-            assignment['submission_grade'] = submission[1]
-            assignment['feedback'] = submission[2]
-        else:
-            assignment['submission_status'] = 'not_submitted'
-            assignment['submission_grade'] = None
-            assignment['feedback'] = None
+                 ORDER BY a.due_date''', (session['user_id'], session['grade'], session['section']))
+    assignments = database.fetch_all(c)
     
     session.modified = True
     conn.close()
     
-    return jsonify({'success': True, 'assignments': assignments})
+    return jsonify({'success': True, 'assignments': assignments,
+                    'next_poll_ms': polling.next_poll_ms(30000)})
 
 @app.route('/api/get_students')
+@polling.polling_endpoint
 def api_get_students():
     if 'user_id' not in session or session['user_type'] != 'teacher':
         return jsonify({'success': False, 'error': 'غير مصرح'})
@@ -848,16 +996,442 @@ def api_get_students():
     # إضافة timestamp لمنع التخزين المؤقت
     timestamp = request.args.get('t', '')
     
-    conn = sqlite3.connect('data/database.db')
+    # كل طلاب المدرسة: القائمة ترمّز وترسل على دفعات أثناء القراءة
+    def students():
+        conn = database.connect()
+        try:
+            yield from database.stream(conn, '''SELECT id, name, username, user_type, grade, section,
+                                                is_active, created_at FROM users
+                                                WHERE user_type = 'student' ORDER BY grade, section, name''')
+        finally:
+            conn.close()
+    
+    session.modified = True
+    
+    return fastjson.stream_jsonify('students', students(), success=True,
+                                   next_poll_ms=polling.next_poll_ms(30000))
+
+# قائمة التصحيح: الحلول غير المصححة في كل واجبات المعلم
+@app.route('/teacher/grading')
+def teacher_grading():
+    if 'user_id' not in session or session['user_type'] != 'teacher':
+        flash('يجب تسجيل الدخول أولاً!', 'error')
+        return redirect('/')
+    
+    session.modified = True
+    assignment_id = request.args.get('assignment_id', type=int)
+    
+    conn = database.connect()
+    queue = grading.ungraded_queue(conn, session['user_id'], assignment_id)
+    summary = grading.queue_summary(conn, session['user_id'])
+    conn.close()
+    
+    return render_template('teacher_grading.html',
+                         queue=queue,
+                         summary=summary,
+                         assignment_id=assignment_id,
+                         session=session)
+
+@app.route('/api/grade_submissions', methods=['POST'])
+def api_grade_submissions():
+    if 'user_id' not in session or session['user_type'] != 'teacher':
+        return jsonify({'success': False, 'error': 'غير مصرح'})
+    
+    data = request.get_json(silent=True) or {}
+    conn = database.connect()
+    try:
+        items = grading.parse_items(data.get('grades'))
+        graded, assignment_ids = grading.grade_many(conn, session['user_id'], items)
+    except grading.GradingError as e:
+        return jsonify({'success': False, 'error': str(e)})
+    except database.Error as e:
+        return jsonify({'success': False, 'error': str(e)})
+    finally:
+        conn.close()
+    
+    session.modified = True
+    return jsonify({'success': True, 'graded': graded, 'assignments': assignment_ids})
+
+# أحداث المستخدم
+@app.route('/api/feed')
+def api_feed():
+    if 'user_id' not in session:
+        return jsonify({'success': False, 'error': 'غير مصرح'})
+    
+    conn = database.connect()
+    items, next_cursor = feed.get_feed(conn, session['user_id'],
+                                       before=request.args.get('before', type=int),
+                                       limit=request.args.get('limit', feed.PAGE_SIZE, type=int))
+    session.modified = True
+    conn.close()
+    
+    return jsonify({'success': True, 'items': items, 'next_cursor': next_cursor})
+
+# إحصائيات الدرجات
+@app.route('/api/gradebook/<grade>/<section>')
+def api_gradebook(grade, section):
+    if 'user_id' not in session or session['user_type'] not in ('teacher', 'admin'):
+        return jsonify({'success': False, 'error': 'غير مصرح'})
+    
+    # المعلم يرى واجباته فقط
+    teacher_id = session['user_id'] if session['user_type'] == 'teacher' else None
+    room_id = request.args.get('room_id', type=int)
+    
+    conn = database.connect()
+    report = gradebook.class_report(conn, grade, section, teacher_id=teacher_id, room_id=room_id)
+    session.modified = True
+    conn.close()
+    
+    return jsonify({'success': True, 'report': report})
+
+@app.route('/api/gradebook/school')
+def api_gradebook_school():
+    if 'user_id' not in session or session['user_type'] != 'admin':
+        return jsonify({'success': False, 'error': 'غير مصرح'})
+    
+    conn = database.connect()
+    classes = gradebook.school_report(conn)
+    session.modified = True
+    conn.close()
+    
+    return jsonify({'success': True, 'classes': classes})
+
+# المهام في الخلفية: الطلب يضيف المهمة فقط، والعامل (python jobs.py worker) ينفذها
+@app.route('/api/jobs', methods=['POST'])
+def api_create_job():
+    if 'user_id' not in session or session['user_type'] != 'admin':
+        return jsonify({'success': False, 'error': 'غير مصرح'})
+    
+    kind = request.form.get('kind', '')
+    if kind not in jobs.handlers:
+        return jsonify({'success': False, 'error': 'نوع مهمة غير معروف'})
+    
+    try:
+        payload = json.loads(request.form.get('payload') or '{}')
+    except ValueError:
+        return jsonify({'success': False, 'error': 'بيانات المهمة غير صالحة'})
+    
+    conn = database.connect()
     c = conn.cursor()
+    job_id = jobs.enqueue(c, kind, payload, created_by=session['user_id'])
+    conn.commit()
+    session.modified = True
+    conn.close()
     
-    c.execute('SELECT * FROM users WHERE user_type = "student" ORDER BY grade, section, name')
-    students = [dict(zip([col[0] for col in c.description], row)) for row in c.fetchall()]
+    return jsonify({'success': True, 'job_id': job_id})
+
+@app.route('/api/jobs')
+def api_list_jobs():
+    if 'user_id' not in session or session['user_type'] != 'admin':
+        return jsonify({'success': False, 'error': 'غير مصرح'})
     
+    conn = database.connect()
+    job_list = jobs.recent_jobs(conn)
     session.modified = True
     conn.close()
     
-    return jsonify({'success': True, 'students': students})
+    return jsonify({'success': True, 'jobs': job_list})
+
+@app.route('/api/jobs/<int:job_id>')
+@polling.polling_endpoint
+def api_job_status(job_id):
+    if 'user_id' not in session:
+        return jsonify({'success': False, 'error': 'غير مصرح'})
+    
+    conn = database.connect()
+    job = jobs.get_job(conn, job_id)
+    conn.close()
+    
+    if not job or (session['user_type'] != 'admin' and job.created_by != session['user_id']):
+        return jsonify({'success': False, 'error': 'المهمة غير موجودة'})
+    
+    result = job.as_dict()
+    result['result'] = json.loads(job.result) if job.result else None
+    finished = job.status in (jobs.DONE, jobs.FAILED)
+    
+    return jsonify({'success': True, 'job': result, 'finished': finished,
+                    'next_poll_ms': None if finished else polling.next_poll_ms(2000)})
+
+# التصدير: الملف يبنى ويرسل على دفعات أثناء القراءة من قاعدة البيانات
+def export_response(export, fmt):
+    return Response(export.stream(fmt),
+                    mimetype=exports.FORMATS[fmt],
+                    headers={'Content-Disposition': "attachment; filename*=UTF-8''" +
+                             quote(export.filename(fmt)),
+                    'X-Accel-Buffering': 'no'})
+
+@app.route('/export/roster.<any(csv, xlsx):fmt>')
+def export_roster(fmt):
+    if 'user_id' not in session or session['user_type'] not in ('teacher', 'admin'):
+        flash('يجب تسجيل الدخول أولاً!', 'error')
+        return redirect('/')
+    
+    # المعلم يصدر قوائم الطلاب فقط
+    user_type = request.args.get('user_type', 'student')
+    if session['user_type'] == 'teacher' or user_type not in ('student', 'teacher', 'admin'):
+        user_type = 'student'
+    
+    session.modified = True
+    export = exports.roster(user_type, request.args.get('grade'), request.args.get('section'))
+    return export_response(export, fmt)
+
+@app.route('/export/gradebook.<any(csv, xlsx):fmt>')
+def export_gradebook(fmt):
+    if 'user_id' not in session or session['user_type'] not in ('teacher', 'admin'):
+        flash('يجب تسجيل الدخول أولاً!', 'error')
+        return redirect('/')
+    
+    # المعلم يصدر واجباته فقط، والمدير يصدر المدرسة كاملة إذا لم يحدد صفاً
+    teacher_id = session['user_id'] if session['user_type'] == 'teacher' else None
+    room_id = request.args.get('room_id', type=int)
+    room = None
+    if room_id is not None:
+        conn = database.connect()
+        room = database.query_one(conn, 'SELECT id, teacher_id, grade, section FROM rooms WHERE id = ?',
+                                  (room_id,))
+        conn.close()
+        if not room or (teacher_id is not None and room.teacher_id != teacher_id):
+            flash('غير مسموح لك بتصدير هذه الغرفة!', 'error')
+            return redirect('/')
+    
+    session.modified = True
+    export = exports.gradebook(grade=request.args.get('grade'),
+                               section=request.args.get('section'),
+                               teacher_id=teacher_id,
+                               room=room,
+                               since=request.args.get('since'),
+                               until=request.args.get('until'))
+    return export_response(export, fmt)
+
+@app.route('/export/room/<int:room_id>/chat.<any(csv, xlsx):fmt>')
+def export_chat(room_id, fmt):
+    if 'user_id' not in session or session['user_type'] not in ('teacher', 'admin'):
+        flash('يجب تسجيل الدخول أولاً!', 'error')
+        return redirect('/')
+    
+    conn = database.connect()
+    room = database.query_one(conn, 'SELECT id, teacher_id FROM rooms WHERE id = ?', (room_id,))
+    conn.close()
+    if not room or (session['user_type'] == 'teacher' and room.teacher_id != session['user_id']):
+        flash('غير مسموح لك بتصدير هذه الغرفة!', 'error')
+        return redirect('/')
+    
+    session.modified = True
+    return export_response(exports.chat_transcript(room_id), fmt)
+
+# الاختبارات
+@app.route('/teacher/exams')
+def teacher_exams():
+    if 'user_id' not in session or session['user_type'] != 'teacher':
+        flash('يجب تسجيل الدخول أولاً!', 'error')
+        return redirect('/')
+    
+    session.modified = True
+    conn = database.connect()
+    c = conn.cursor()
+    
+    c.execute('''SELECT e.id, e.title, e.subject, e.grade, e.section, e.duration, e.total_marks,
+                 e.start_time, e.end_time,
+                 (SELECT COUNT(*) FROM exam_attempts WHERE exam_id = e.id) as attempts_count,
+                 (SELECT COUNT(*) FROM exam_attempts WHERE exam_id = e.id
+                  AND status = 'graded') as graded_count,
+                 (SELECT COUNT(*) FROM exam_attempts WHERE exam_id = e.id
+                  AND status = 'pending_review') as review_count
+                 FROM exams e WHERE teacher_id = ? AND is_active = 1
+                 ORDER BY start_time DESC''', (session['user_id'],))
+    exam_list = database.fetch_all(c)
+    
+    conn.close()
+    
+    return render_template('teacher_exams.html',
+                         exams=exam_list,
+                         session=session)
+
+@app.route('/student/exams')
+def student_exams():
+    if 'user_id' not in session or session['user_type'] != 'student':
+        flash('يجب تسجيل الدخول أولاً!', 'error')
+        return redirect('/')
+    
+    session.modified = True
+    conn = database.connect()
+    c = conn.cursor()
+    
+    c.execute('''SELECT e.id, e.title, e.subject, e.duration, e.total_marks, e.start_time, e.end_time,
+                 a.status as attempt_status, a.score
+                 FROM exams e
+                 LEFT JOIN exam_attempts a ON a.exam_id = e.id AND a.student_id = ?
+                 WHERE e.grade = ? AND e.section = ? AND e.is_active = 1
+                 ORDER BY e.start_time''',
+              (session['user_id'], session['grade'], session['section']))
+    exam_list = database.fetch_all(c)
+    
+    conn.close()
+    
+    return render_template('student_exams.html',
+                         exams=exam_list,
+                         now=datetime.now().strftime(exams.TIME_FORMAT),
+                         session=session)
+
+@app.route('/student/exam/<int:exam_id>')
+def student_exam(exam_id):
+    if 'user_id' not in session or session['user_type'] != 'student':
+        flash('يجب تسجيل الدخول أولاً!', 'error')
+        return redirect('/')
+    
+    session.modified = True
+    
+    # الورقة من الذاكرة حتى لا يقرأ كل طالب الأسئلة من قاعدة البيانات عند البدء
+    paper = exams.get_paper(exam_id)
+    if (not paper or paper.exam['grade'] != session['grade']
+            or paper.exam['section'] != session['section']):
+        flash('غير مسموح لك بالدخول إلى هذا الاختبار!', 'error')
+        return redirect('/student/exams')
+    
+    if not paper.is_open():
+        flash('الاختبار غير متاح حالياً!', 'error')
+        return redirect('/student/exams')
+    
+    # تسجيل البدء مؤجل ويكتب مع أول دفعة حفظ
+    exams.answer_buffer.start_attempt(exam_id, session['user_id'])
+    
+    return render_template('student_exam.html',
+                         exam=paper.exam,
+                         questions=paper.public_questions,
+                         deadline=paper.deadline.strftime(exams.TIME_FORMAT),
+                         session=session)
+
+@app.route('/api/create_exam', methods=['POST'])
+def api_create_exam():
+    if 'user_id' not in session or session['user_type'] != 'teacher':
+        return jsonify({'success': False, 'error': 'غير مصرح'})
+    
+    conn = database.connect()
+    try:
+        exam_id = exams.create_exam(conn, session['user_id'],
+                                    request.form['title'],
+                                    request.form['subject'],
+                                    request.form['grade'],
+                                    request.form['section'],
+                                    request.form['duration'],
+                                    request.form['total_marks'],
+                                    request.form['start_time'],
+                                    request.form['end_time'],
+                                    json.loads(request.form['questions']))
+        session.modified = True
+        conn.close()
+        
+        return jsonify({'success': True, 'exam_id': exam_id})
+    except Exception as e:
+        conn.close()
+        return jsonify({'success': False, 'error': str(e)})
+
+@app.route('/api/exam/<int:exam_id>/save_answer', methods=['POST'])
+def api_save_exam_answer(exam_id):
+    if 'user_id' not in session or session['user_type'] != 'student':
+        return jsonify({'success': False, 'error': 'غير مصرح'})
+    
+    paper = exams.get_paper(exam_id)
+    if not paper or paper.exam['grade'] != session['grade'] or paper.exam['section'] != session['section']:
+        return jsonify({'success': False, 'error': 'غير مسموح لك بالإجابة في هذا الاختبار'})
+    
+    if not paper.is_open():
+        return jsonify({'success': False, 'error': 'انتهى وقت الاختبار'})
+    
+    with database.connection() as conn:
+        status = exams.attempt_status(conn, exam_id, session['user_id'])
+    if status not in (None, 'in_progress'):
+        return jsonify({'success': False, 'error': 'تم تسليم هذا الاختبار مسبقاً'})
+    
+    # الحفظ في الذاكرة فقط، والكتابة إلى قاعدة البيانات على دفعات
+    exams.answer_buffer.save(exam_id, session['user_id'],
+                             request.form['question_id'],
+                             request.form.get('answer', ''))
+    session.modified = True
+    
+    return jsonify({'success': True})
+
+@app.route('/api/exam/<int:exam_id>/submit', methods=['POST'])
+def api_submit_exam(exam_id):
+    if 'user_id' not in session or session['user_type'] != 'student':
+        return jsonify({'success': False, 'error': 'غير مصرح'})
+    
+    paper = exams.get_paper(exam_id)
+    if not paper or paper.exam['grade'] != session['grade'] or paper.exam['section'] != session['section']:
+        return jsonify({'success': False, 'error': 'غير مسموح لك بتسليم هذا الاختبار'})
+    
+    # مهلة دقيقة بعد الموعد لتأخر الشبكة
+    if datetime.now() > paper.deadline + timedelta(minutes=1):
+        return jsonify({'success': False, 'error': 'انتهى وقت الاختبار'})
+    
+    conn = database.connect()
+    try:
+        answers = json.loads(request.form.get('answers', '{}'))
+        exams.submit_attempt(conn, exam_id, session['user_id'], answers)
+        session.modified = True
+        conn.close()
+        
+        return jsonify({'success': True})
+    except Exception as e:
+        conn.close()
+        return jsonify({'success': False, 'error': str(e)})
+
+@app.route('/api/exam/<int:exam_id>/results')
+def api_exam_results(exam_id):
+    if 'user_id' not in session or session['user_type'] != 'teacher':
+        return jsonify({'success': False, 'error': 'غير مصرح'})
+    
+    conn = database.connect()
+    c = conn.cursor()
+    
+    c.execute('SELECT id FROM exams WHERE id = ? AND teacher_id = ?', (exam_id, session['user_id']))
+    if not c.fetchone():
+        conn.close()
+        return jsonify({'success': False, 'error': 'غير مسموح لك بالوصول إلى هذا الاختبار'})
+    
+    # تصحيح أي محاولات متبقية قبل عرض النتائج
+    exams.answer_buffer.flush(conn)
+    paper = exams.get_paper(exam_id)
+    if paper:
+        exams.grade_pending_attempts(conn, paper)
+    
+    c.execute('''SELECT a.student_id, u.name as student_name, a.started_at, a.submitted_at,
+                 a.score, a.status
+                 FROM exam_attempts a
+                 JOIN users u ON a.student_id = u.id
+                 WHERE a.exam_id = ? ORDER BY u.name''', (exam_id,))
+    results = database.fetch_all(c)
+    
+    session.modified = True
+    conn.close()
+    
+    return jsonify({'success': True, 'results': results})
+
+# مراجعة الأسئلة المقالية: عرض إجابات الطالب (GET) ثم حفظ درجاتها (POST)
+@app.route('/api/exam/<int:exam_id>/review/<int:student_id>', methods=['GET', 'POST'])
+def api_review_exam_attempt(exam_id, student_id):
+    if 'user_id' not in session or session['user_type'] != 'teacher':
+        return jsonify({'success': False, 'error': 'غير مصرح'})
+    
+    paper = exams.get_paper(exam_id)
+    if not paper or paper.exam['teacher_id'] != session['user_id']:
+        return jsonify({'success': False, 'error': 'غير مسموح لك بالوصول إلى هذا الاختبار'})
+    
+    conn = database.connect()
+    try:
+        if request.method == 'GET':
+            answers = exams.essay_answers(conn, paper, student_id)
+            conn.close()
+            return jsonify({'success': True, 'questions': answers})
+    
+        exams.review_attempt(conn, paper, student_id, json.loads(request.form.get('marks', '{}')))
+        session.modified = True
+        conn.close()
+    
+        return jsonify({'success': True})
+    except Exception as e:
+        conn.close()
+        return jsonify({'success': False, 'error': str(e)})
 
 @app.route('/logout')
 def logout():
@@ -0,0 +1,290 @@
+﻿import os
+import sys
+import gzip
+import time
+import shutil
+import sqlite3
+import argparse
+import subprocess
+import tempfile
+from datetime import datetime
+
+import database
+from config import Config
+
+SNAPSHOT_PREFIX = 'database-'
+SNAPSHOT_SUFFIX = '.db.gz'
+# نسخ PostgreSQL: ملف SQL من pg_dump مضغوط
+DUMP_SUFFIX = '.sql.gz'
+DUMP_COMPLETE = '-- PostgreSQL database dump complete'
+
+# عدد مرات إعادة النسخ المسموح بها إذا تغيرت القاعدة أثناء النسخ قبل النسخ بخطوة واحدة
+MAX_RESTARTS = 5
+
+# نسبة مرحلة النسخ من التقدم الكلي، والباقي للضغط
+COPY_SHARE = 0.8
+CHUNK_SIZE = 1024 * 1024
+
+
+class BackupError(Exception):
+    pass
+
+
+class _TooManyRestarts(Exception):
+    pass
+
+
+def _require_sqlite():
+    if database.backend.name != 'sqlite':
+        raise BackupError('الاسترجاع المباشر متاح لـ SQLite فقط، استرجع نسخ PostgreSQL بـ: gunzip -c FILE | psql DATABASE_URL')
+
+
+def _copy_online(source, target_path, pages, pause, report=None):
+    restarts = [0, None]
+
+    def progress(status, remaining, total):
+        # إذا زاد المتبقي فقد تغيرت القاعدة وبدأ النسخ من جديد
+        if restarts[1] is not None and remaining > restarts[1]:
+            restarts[0] += 1
+            if restarts[0] > MAX_RESTARTS:
+                raise _TooManyRestarts()
+        restarts[1] = remaining
+        if report and total:
+            report(COPY_SHARE * (total - remaining) / total, 'نسخ قاعدة البيانات')
+        # استراحة قصيرة بين الخطوات حتى تستمر الدردشة والتسليمات
+        if pause:
+            time.sleep(pause)
+
+    target = sqlite3.connect(target_path)
+    try:
+        try:
+            source.backup(target, pages=pages, progress=progress)
+        except _TooManyRestarts:
+            # في وضع WAL القراءة دفعة واحدة لا تمنع الكتابة
+            source.backup(target, pages=-1)
+    finally:
+        target.close()
+
+
+# PostgreSQL: pg_dump يقرأ لقطة متسقة دون إيقاف الكتابة
+def _dump_postgres(target_path, report=None):
+    if report:
+        report(0, 'تصدير قاعدة البيانات (pg_dump)')
+    try:
+        subprocess.run(['pg_dump', '--no-owner', '--no-privileges', '--file', target_path,
+                        database.backend.url], check=True, stderr=subprocess.PIPE)
+    except FileNotFoundError:
+        raise BackupError('pg_dump غير مثبت على هذا الخادم')
+    except subprocess.CalledProcessError as e:
+        raise BackupError('فشل pg_dump: ' + e.stderr.decode('utf-8', 'replace').strip())
+    if report:
+        report(COPY_SHARE, 'تصدير قاعدة البيانات (pg_dump)')
+
+
+# الأجزاء من الثانية حتى لا تتطابق أسماء نسختين متتاليتين (مثل نسخة الأمان قبل الاسترجاع)
+def snapshot_name(now=None, attempt=0, suffix=SNAPSHOT_SUFFIX):
+    now = now or datetime.now()
+    return (SNAPSHOT_PREFIX + now.strftime('%Y%m%d-%H%M%S-%f')
+            + ('-%d' % attempt if attempt else '') + suffix)
+
+
+# نشر الملف باسمه النهائي دون الكتابة فوق نسخة موجودة (os.link يفشل إذا وجد الاسم)
+def _publish(temp_path, folder, suffix=SNAPSHOT_SUFFIX):
+    now = datetime.now()
+    attempt = 0
+    while True:
+        path = os.path.join(folder, snapshot_name(now, attempt, suffix))
+        try:
+            os.link(temp_path, path)
+            return path
+        except FileExistsError:
+            attempt += 1
+
+
+def list_snapshots(folder=None):
+    folder = folder or Config.BACKUP_FOLDER
+    if not os.path.isdir(folder):
+        return []
+    names = [name for name in os.listdir(folder)
+             if name.startswith(SNAPSHOT_PREFIX) and name.endswith((SNAPSHOT_SUFFIX, DUMP_SUFFIX))]
+    return [os.path.join(folder, name) for name in sorted(names)]
+
+
+def rotate(folder=None, keep=None):
+    keep = Config.BACKUP_KEEP if keep is None else keep
+    snapshots = list_snapshots(folder)
+    # keep = 0 يعني الاحتفاظ بكل النسخ
+    removed = snapshots[:-keep] if keep > 0 else []
+    for path in removed:
+        os.remove(path)
+    return removed
+
+
+def _compress(raw_path, path, report=None):
+    total = os.path.getsize(raw_path) or 1
+    done = 0
+    with open(raw_path, 'rb') as raw, gzip.open(path, 'wb') as compressed:
+        while True:
+            chunk = raw.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            compressed.write(chunk)
+            done += len(chunk)
+            if report:
+                report(COPY_SHARE + (1 - COPY_SHARE) * done / total, 'ضغط النسخة')
+
+
+# نسخة احتياطية مضغوطة دون إيقاف الخادم (نسخ مباشر في SQLite و pg_dump في PostgreSQL)
+# report(fraction, message) اختياري لمتابعة التقدم (مثلاً من مهمة في الخلفية)
+def create_snapshot(folder=None, pages=None, pause=None, keep=None, report=None):
+    postgres = database.backend.name != 'sqlite'
+    folder = folder or Config.BACKUP_FOLDER
+    pages = Config.BACKUP_PAGES if pages is None else pages
+    pause = Config.BACKUP_PAUSE if pause is None else pause
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+
+    fd, raw_path = tempfile.mkstemp(suffix='.sql' if postgres else '.db', dir=folder)
+    os.close(fd)
+    compressed_path = raw_path + '.gz.tmp'
+    try:
+        if postgres:
+            _dump_postgres(raw_path, report)
+        else:
+            source = database.connect()
+            try:
+                _copy_online(source, raw_path, pages, pause, report)
+            finally:
+                source.close()
+
+        _compress(raw_path, compressed_path, report)
+        # الاسم النهائي يظهر فقط بعد اكتمال الكتابة
+        path = _publish(compressed_path, folder, DUMP_SUFFIX if postgres else SNAPSHOT_SUFFIX)
+    finally:
+        for leftover in (raw_path, compressed_path):
+            if os.path.exists(leftover):
+                os.remove(leftover)
+
+    rotate(folder, keep)
+    return path
+
+
+def _decompress(path, target_path):
+    with gzip.open(path, 'rb') as compressed, open(target_path, 'wb') as raw:
+        shutil.copyfileobj(compressed, raw)
+
+
+def _check(conn):
+    result = conn.execute('PRAGMA integrity_check').fetchone()[0]
+    if result != 'ok':
+        raise BackupError('النسخة الاحتياطية تالفة: ' + result)
+    tables = [row[0] for row in conn.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%'")]
+    if 'users' not in tables:
+        raise BackupError('النسخة الاحتياطية لا تحتوي على جدول المستخدمين')
+    return {table: conn.execute('SELECT COUNT(*) FROM "%s"' % table).fetchone()[0]
+            for table in tables}
+
+
+# ملف pg_dump: قراءته كاملاً يتحقق من الضغط، ونهايته تثبت أن التصدير اكتمل
+def _check_dump(path):
+    counts = {}
+    table = None
+    complete = False
+    with gzip.open(path, 'rt', encoding='utf-8') as dump:
+        for line in dump:
+            line = line.rstrip('\n')
+            if table is not None:
+                if line == '\\.':
+                    table = None
+                else:
+                    counts[table] += 1
+            elif line.startswith('COPY '):
+                table = line.split()[1].split('.')[-1].strip('"')
+                counts[table] = 0
+            elif line == DUMP_COMPLETE:
+                complete = True
+    if not complete:
+        raise BackupError('النسخة الاحتياطية غير مكتملة')
+    if 'users' not in counts:
+        raise BackupError('النسخة الاحتياطية لا تحتوي على جدول المستخدمين')
+    return counts
+
+
+# فك الضغط والتحقق من سلامة النسخة وإرجاع عدد الصفوف في كل جدول
+def verify_snapshot(path):
+    if path.endswith(DUMP_SUFFIX):
+        return _check_dump(path)
+    fd, raw_path = tempfile.mkstemp(suffix='.db')
+    os.close(fd)
+    try:
+        _decompress(path, raw_path)
+        conn = sqlite3.connect(raw_path)
+        try:
+            return _check(conn)
+        finally:
+            conn.close()
+    finally:
+        os.remove(raw_path)
+
+
+# استرجاع نسخة إلى القاعدة الحالية بعد أخذ نسخة أمان منها
+def restore_snapshot(path, folder=None):
+    _require_sqlite()
+    if path.endswith(DUMP_SUFFIX):
+        raise BackupError('هذه نسخة PostgreSQL، استرجعها بـ: gunzip -c FILE | psql DATABASE_URL')
+    verify_snapshot(path)
+    safety = create_snapshot(folder, keep=0) if os.path.exists(database.backend.path) else None
+
+    fd, raw_path = tempfile.mkstemp(suffix='.db')
+    os.close(fd)
+    try:
+        _decompress(path, raw_path)
+        source = sqlite3.connect(raw_path)
+        target = database.connect()
+        try:
+            source.backup(target)
+        finally:
+            target.close()
+            source.close()
+    finally:
+        os.remove(raw_path)
+    return safety
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='النسخ الاحتياطي لقاعدة البيانات')
+    sub = parser.add_subparsers(dest='command', required=True)
+    sub.add_parser('create', help='إنشاء نسخة احتياطية')
+    sub.add_parser('list', help='عرض النسخ الموجودة')
+    verify = sub.add_parser('verify', help='التحقق من نسخة')
+    verify.add_argument('path', nargs='?')
+    restore = sub.add_parser('restore', help='استرجاع نسخة')
+    restore.add_argument('path')
+    args = parser.parse_args(argv)
+
+    try:
+        if args.command == 'create':
+            print(create_snapshot())
+        elif args.command == 'list':
+            for path in list_snapshots():
+                print(path, os.path.getsize(path))
+        elif args.command == 'verify':
+            snapshots = list_snapshots()
+            path = args.path or (snapshots[-1] if snapshots else None)
+            if not path:
+                raise BackupError('لا توجد نسخ احتياطية')
+            for table, count in verify_snapshot(path).items():
+                print(table, count)
+            print('ok', path)
+        elif args.command == 'restore':
+            safety = restore_snapshot(args.path)
+            print('restored', args.path, 'safety copy:', safety)
+    except BackupError as e:
+        print(e, file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,162 @@
+﻿import time
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+import database
+from config import Config
+
+# أنواع الكيانات التي ترتبط بها القيم المخزنة
+ROOM = 'room'
+ASSIGNMENT = 'assignment'
+USER = 'user'
+CLASS = 'class'
+EXAM = 'exam'
+
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+def init_cache_tables(c):
+    # سجل التغييرات: كل كتابة تضيف صفاً، وكل عامل يقرأ ما بعد آخر معرف رآه
+    c.execute('''CREATE TABLE IF NOT EXISTS cache_changes
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  entity TEXT NOT NULL,
+                  entity_id TEXT,
+                  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
+
+
+# ذاكرة مؤقتة داخل العملية، القيم مجمعة حسب الكيان حتى تحذف معاً عند تغيره
+# لكل كيان رقم إصدار يزيد عند كل حذف، يستخدم مفتاحاً للأجزاء المعروضة من القوالب
+class EntityCache:
+    def __init__(self, max_entities):
+        self.max_entities = max_entities
+        self.entries = OrderedDict()
+        self.versions = {}
+        self.generations = {}
+        self.epoch = 0
+        self.lock = threading.Lock()
+
+    def get(self, entity, entity_id, name, default=None):
+        key = (entity, str(entity_id))
+        with self.lock:
+            values = self.entries.get(key)
+            if values is None or name not in values:
+                return default
+            self.entries.move_to_end(key)
+            return values[name]
+
+    def set(self, entity, entity_id, name, value):
+        key = (entity, str(entity_id))
+        with self.lock:
+            self.entries.setdefault(key, {})[name] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entities:
+                self.entries.popitem(last=False)
+
+    # entity_id = None يحذف كل قيم هذا النوع
+    def evict(self, entity, entity_id=None):
+        with self.lock:
+            if entity_id is None:
+                for key in [key for key in self.entries if key[0] == entity]:
+                    del self.entries[key]
+                self.generations[entity] = self.generations.get(entity, 0) + 1
+            else:
+                key = (entity, str(entity_id))
+                self.entries.pop(key, None)
+                self.versions[key] = self.versions.get(key, 0) + 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.epoch += 1
+
+    def version(self, entity, entity_id):
+        return (self.epoch, self.generations.get(entity, 0),
+                self.versions.get((entity, str(entity_id)), 0))
+
+
+entities = EntityCache(Config.CACHE_MAX_ENTITIES)
+
+_MISSING = object()
+
+
+def get_or_load(entity, entity_id, name, loader):
+    value = entities.get(entity, entity_id, name, _MISSING)
+    if value is _MISSING:
+        value = loader()
+        entities.set(entity, entity_id, name, value)
+    return value
+
+
+# تسجيل تغيير في نفس معاملة الكتابة؛ العمال الآخرون يحذفون القيم عند المزامنة التالية
+def changed(c, entity, entity_id=None):
+    c.execute('INSERT INTO cache_changes (entity, entity_id) VALUES (?, ?)',
+              (entity, None if entity_id is None else str(entity_id)))
+    entities.evict(entity, entity_id)
+
+
+# أقصى عدد معرفات ناقصة تتابع في وقت واحد
+MAX_GAPS = 1000
+
+_last_id = None
+# المعرفات التي تخطيناها ولم تظهر بعد: في PostgreSQL قد تُثبت معاملة بمعرف أصغر
+# بعد معاملة بمعرف أكبر، فتُقرأ هذه المعرفات مجدداً حتى تظهر أو تنتهي مهلتها
+_gaps = {}
+_last_sync = 0.0
+_last_trim = 0.0
+_sync_lock = threading.Lock()
+
+
+def _read_changes(conn, now):
+    global _last_id
+    for gap, seen in list(_gaps.items()):
+        if now - seen > Config.CACHE_GAP_SECONDS:
+            # معاملة ألغيت أو انتهت منذ وقت طويل
+            del _gaps[gap]
+
+    query = 'SELECT id, entity, entity_id FROM cache_changes WHERE id > ?'
+    params = [_last_id]
+    if _gaps:
+        query += ' OR id IN (%s)' % ', '.join('?' * len(_gaps))
+        params.extend(_gaps)
+    for change_id, entity, entity_id in conn.execute(query + ' ORDER BY id', params).fetchall():
+        entities.evict(entity, entity_id)
+        if change_id in _gaps:
+            del _gaps[change_id]
+        elif change_id > _last_id:
+            for gap in range(_last_id + 1, min(change_id, _last_id + 1 + MAX_GAPS - len(_gaps))):
+                _gaps[gap] = now
+            _last_id = change_id
+
+
+# قراءة التغييرات الجديدة من السجل وحذف القيم المتأثرة (مرة كل CACHE_SYNC_INTERVAL على الأكثر)
+def sync(force=False):
+    global _last_id, _last_sync, _last_trim
+    now = time.monotonic()
+    if not force and now - _last_sync < Config.CACHE_SYNC_INTERVAL:
+        return
+    if not _sync_lock.acquire(blocking=False):
+        # عامل آخر في نفس العملية يزامن الآن
+        return
+    try:
+        conn = database.connect()
+        try:
+            if _last_id is None or now - _last_sync > Config.CACHE_CHANGES_KEEP:
+                # أول مزامنة أو انقطاع أطول من مدة حفظ السجل: لا نعرف ما فاتنا
+                entities.clear()
+                _gaps.clear()
+                _last_id = database.query_value(conn, 'SELECT MAX(id) FROM cache_changes') or 0
+            else:
+                _read_changes(conn, now)
+
+            if now - _last_trim > Config.CACHE_CHANGES_KEEP / 10.0:
+                cutoff = datetime.utcnow() - timedelta(seconds=Config.CACHE_CHANGES_KEEP)
+                conn.execute('DELETE FROM cache_changes WHERE created_at < ?',
+                             (cutoff.strftime(TIME_FORMAT),))
+                conn.commit()
+                _last_trim = now
+        finally:
+            conn.close()
+        _last_sync = now
+    finally:
+        _sync_lock.release()
@@ -0,0 +1,359 @@
+﻿import os
+import re
+import itertools
+import contextlib
+import sqlite3
+import threading
+
+from config import Config
+
+
+# SQLite: ملف واحد على نفس الخادم
+class SQLiteBackend:
+    name = 'sqlite'
+    Error = sqlite3.Error
+    IntegrityError = sqlite3.IntegrityError
+
+    def __init__(self, path):
+        self.path = path
+
+    def connect(self):
+        # مهلة انتظار طويلة حتى لا يفشل الطلب عند ازدحام قفل الكتابة
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.execute('PRAGMA busy_timeout = 30000')
+        return conn
+
+    def setup(self, conn):
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        # وضع WAL يسمح بالقراءة أثناء الكتابة ويقلل تعارض الأقفال
+        conn.execute('PRAGMA journal_mode=WAL')
+
+    def insert(self, cursor, sql, params=()):
+        cursor.execute(sql, params)
+        return cursor.lastrowid
+
+    def stream_cursor(self, conn, size):
+        # مؤشر sqlite3 يقرأ الصفوف من الملف عند الطلب
+        return conn.cursor()
+
+    def close_all(self):
+        # اتصالات SQLite لا تحجز مكاناً في مجمع
+        pass
+
+
+# PostgreSQL: عدة خوادم للتطبيق خلف موزع الأحمال مع مجمع اتصالات لكل عملية
+class PostgresBackend:
+    name = 'postgresql'
+
+    def __init__(self, url, minconn, maxconn):
+        # الاستيراد هنا حتى لا تكون psycopg2 مطلوبة عند استخدام SQLite
+        import psycopg2
+        import psycopg2.extras
+        import psycopg2.pool
+        self.psycopg2 = psycopg2
+        self.Error = psycopg2.Error
+        self.IntegrityError = psycopg2.IntegrityError
+        self.url = url
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.pool = None
+        self.pool_pid = None
+        self.lock = threading.Lock()
+        self.cursor_ids = itertools.count(1)
+        # الاتصالات التي أخذها كل خيط من المجمع ولم يعدها بعد
+        self.local = threading.local()
+
+    def get_pool(self):
+        # كل عامل في gunicorn يحتاج مجمعاً خاصاً به بعد fork
+        if self.pool is None or self.pool_pid != os.getpid():
+            with self.lock:
+                if self.pool is None or self.pool_pid != os.getpid():
+                    self.pool = self.psycopg2.pool.ThreadedConnectionPool(
+                        self.minconn, self.maxconn, self.url)
+                    self.pool_pid = os.getpid()
+        return self.pool
+
+    def connect(self):
+        pool = self.get_pool()
+        conn = PostgresConnection(self, pool, pool.getconn())
+        self.opened().add(conn)
+        return conn
+
+    def opened(self):
+        if not hasattr(self.local, 'connections'):
+            self.local.connections = set()
+        return self.local.connections
+
+    # إعادة ما بقي مفتوحاً في هذا الخيط (مسار خطأ نسي close) إلى المجمع
+    def close_all(self):
+        for conn in list(self.opened()):
+            conn.close()
+
+    def setup(self, conn):
+        pass
+
+    def insert(self, cursor, sql, params=()):
+        cursor.execute(sql + ' RETURNING id', params)
+        return cursor.fetchone()[0]
+
+    def stream_cursor(self, conn, size):
+        # مؤشر مسمى: النتائج تبقى في الخادم وتنقل على دفعات
+        cursor = conn.conn.cursor(name='stream_%d_%d' % (os.getpid(), next(self.cursor_ids)))
+        cursor.itersize = size
+        return PostgresCursor(cursor)
+
+
+# تحويل SQL المكتوب لـ SQLite إلى صيغة PostgreSQL
+_NOW_SQL = "to_char(CURRENT_TIMESTAMP AT TIME ZONE 'UTC', 'YYYY-MM-DD HH24:MI:SS')"
+_DDL_REWRITES = [
+    (re.compile(r'INTEGER PRIMARY KEY AUTOINCREMENT', re.I), 'SERIAL PRIMARY KEY'),
+    (re.compile(r'BOOLEAN DEFAULT 1', re.I), 'INTEGER DEFAULT 1'),
+    (re.compile(r'\bBLOB\b', re.I), 'BYTEA'),
+    # التواريخ تبقى نصوصاً كما في SQLite حتى تعمل القوالب بنفس الطريقة
+    (re.compile(r'\b(TIMESTAMP|DATE)\b', re.I), 'TEXT'),
+]
+_translated = {}
+
+
+def translate_sql(sql):
+    result = _translated.get(sql)
+    if result is None:
+        result = sql.replace('%', '%%').replace('?', '%s')
+        if result.lstrip().upper().startswith('CREATE TABLE'):
+            for pattern, replacement in _DDL_REWRITES:
+                result = pattern.sub(replacement, result)
+        result = re.sub(r'\bCURRENT_TIMESTAMP\b', _NOW_SQL, result)
+        _translated[sql] = result
+    return result
+
+
+class PostgresCursor:
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def execute(self, sql, params=()):
+        self.cursor.execute(translate_sql(sql), tuple(params))
+        return self
+
+    def executemany(self, sql, seq_of_params):
+        from psycopg2.extras import execute_batch
+        execute_batch(self.cursor, translate_sql(sql), [tuple(p) for p in seq_of_params])
+        return self
+
+    def fetchone(self):
+        return self.cursor.fetchone()
+
+    def fetchall(self):
+        return self.cursor.fetchall()
+
+    def fetchmany(self, size):
+        return self.cursor.fetchmany(size)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+    @property
+    def description(self):
+        return self.cursor.description
+
+    @property
+    def rowcount(self):
+        return self.cursor.rowcount
+
+    def close(self):
+        self.cursor.close()
+
+
+# واجهة مطابقة لاتصال sqlite3 حتى تعمل المسارات دون تغيير
+class PostgresConnection:
+    def __init__(self, backend, pool, conn):
+        self.backend = backend
+        self.pool = pool
+        self.conn = conn
+
+    def cursor(self):
+        return PostgresCursor(self.conn.cursor())
+
+    def execute(self, sql, params=()):
+        return self.cursor().execute(sql, params)
+
+    def executemany(self, sql, seq_of_params):
+        return self.cursor().executemany(sql, seq_of_params)
+
+    def commit(self):
+        self.conn.commit()
+
+    def rollback(self):
+        self.conn.rollback()
+
+    def close(self):
+        # إعادة الاتصال إلى المجمع بدلاً من إغلاقه
+        if self.conn is None:
+            return
+        try:
+            self.conn.rollback()
+            self.pool.putconn(self.conn)
+        except self.backend.Error:
+            self.pool.putconn(self.conn, close=True)
+        self.conn = None
+        self.backend.opened().discard(self)
+
+
+def create_backend(url):
+    if url.startswith('sqlite:///'):
+        return SQLiteBackend(url[len('sqlite:///'):])
+    if url.startswith(('postgres://', 'postgresql://')):
+        return PostgresBackend(url, Config.DATABASE_POOL_MIN, Config.DATABASE_POOL_MAX)
+    raise ValueError('قاعدة بيانات غير مدعومة: ' + url)
+
+
+backend = create_backend(Config.DATABASE_URL)
+
+# أنواع الأخطاء المستخدمة في المسارات، مستقلة عن نوع قاعدة البيانات
+Error = backend.Error
+IntegrityError = backend.IntegrityError
+
+
+def connect():
+    return backend.connect()
+
+
+# with database.connection() as conn: يغلق الاتصال (ويعيده إلى المجمع) حتى عند الخطأ
+@contextlib.contextmanager
+def connection():
+    conn = connect()
+    try:
+        yield conn
+    finally:
+        conn.close()
+
+
+# يستدعى في نهاية كل طلب: أي اتصال نسيه مسار خطأ يعود إلى المجمع هنا وليس عند جمع القمامة
+def close_db():
+    backend.close_all()
+
+
+def setup(conn):
+    backend.setup(conn)
+
+
+# إدخال صف وإرجاع معرفه (lastrowid في SQLite و RETURNING في PostgreSQL)
+def insert(cursor, sql, params=()):
+    return backend.insert(cursor, sql, params)
+
+
+# صف خفيف مبني على tuple: الوصول بالاسم (row.name أو row['name']) أو بالرقم (row[0])
+# خريطة الأعمدة مشتركة بين كل صفوف الاستعلام ولا تبنى لكل صف
+class Row:
+    __slots__ = ('_values',)
+
+    _fields = ()
+    _index = {}
+
+    def __init__(self, values):
+        self._values = values
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            return self._values[self._index[key]]
+        return self._values[key]
+
+    def __getattr__(self, name):
+        try:
+            return self._values[self._index[name]]
+        except KeyError:
+            raise AttributeError(name) from None
+
+    def get(self, key, default=None):
+        index = self._index.get(key)
+        return default if index is None else self._values[index]
+
+    def keys(self):
+        return self._index.keys()
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def __iter__(self):
+        return iter(self._values)
+
+    def __len__(self):
+        return len(self._values)
+
+    def __eq__(self, other):
+        if isinstance(other, Row):
+            return self._values == other._values and self._fields == other._fields
+        return NotImplemented
+
+    def __hash__(self):
+        return hash(self._values)
+
+    def __repr__(self):
+        return 'Row(%s)' % ', '.join('%s=%r' % item for item in self.items())
+
+    def items(self):
+        return [(name, self._values[index]) for name, index in self._index.items()]
+
+    def as_dict(self):
+        return {name: self._values[index] for name, index in self._index.items()}
+
+
+_row_classes = {}
+
+
+# صنف صف لكل مجموعة أعمدة، يبنى مرة واحدة ويعاد استخدامه
+def row_class(description):
+    fields = tuple(col[0] for col in description)
+    cls = _row_classes.get(fields)
+    if cls is None:
+        # عند تكرار اسم العمود يفوز الأخير، مثل dict(zip(...)) سابقاً
+        index = {name: position for position, name in enumerate(fields)}
+        cls = type('Row', (Row,), {'__slots__': (), '_fields': fields, '_index': index})
+        _row_classes[fields] = cls
+    return cls
+
+
+def fetch_all(cursor):
+    if cursor.description is None:
+        return []
+    return list(map(row_class(cursor.description), cursor.fetchall()))
+
+
+def fetch_one(cursor):
+    row = cursor.fetchone()
+    if row is None:
+        return None
+    return row_class(cursor.description)(row)
+
+
+def query_all(conn, sql, params=()):
+    return fetch_all(conn.execute(sql, params))
+
+
+def query_one(conn, sql, params=()):
+    return fetch_one(conn.execute(sql, params))
+
+
+def query_value(conn, sql, params=()):
+    row = conn.execute(sql, params).fetchone()
+    return row[0] if row else None
+
+
+# قراءة نتيجة كبيرة على دفعات دون تحميلها كلها في الذاكرة
+def stream(conn, sql, params=(), size=500):
+    c = backend.stream_cursor(conn, size)
+    try:
+        c.execute(sql, params)
+        cls = None
+        while True:
+            rows = c.fetchmany(size)
+            if not rows:
+                break
+            # المؤشر المسمى في PostgreSQL لا يعرف أعمدته قبل أول قراءة
+            cls = cls or row_class(c.description)
+            for values in rows:
+                yield cls(values)
+    finally:
+        c.close()
@@ -0,0 +1,348 @@
+﻿import json
+import threading
+import time
+import atexit
+from datetime import datetime, timedelta
+
+import cache
+import database
+
+# أنواع الأسئلة التي تصحح آلياً
+OBJECTIVE_TYPES = ('mcq', 'true_false', 'short')
+
+# إعدادات الحفظ التلقائي المؤجل
+FLUSH_SIZE = 200        # عدد الإجابات قبل الكتابة الفورية
+FLUSH_INTERVAL = 5      # ثواني بين كل كتابة دورية
+
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# لا تكتب إجابة لمحاولة سُلمت: إجابة متأخرة في ذاكرة عامل آخر لا تغير إجابات مصححة
+SAVE_ANSWER_SQL = '''INSERT INTO exam_answers (exam_id, student_id, question_id, answer, saved_at)
+                     SELECT v.exam_id, v.student_id, v.question_id, v.answer, v.saved_at
+                     FROM (SELECT ? as exam_id, ? as student_id, ? as question_id,
+                                  ? as answer, ? as saved_at) v
+                     WHERE NOT EXISTS (SELECT 1 FROM exam_attempts att
+                                       WHERE att.exam_id = v.exam_id AND att.student_id = v.student_id
+                                       AND att.status != 'in_progress')
+                     ON CONFLICT (exam_id, student_id, question_id)
+                     DO UPDATE SET answer = excluded.answer, saved_at = excluded.saved_at'''
+
+
+# إنشاء جداول الاختبارات
+def init_exam_tables(c):
+    c.execute('''CREATE TABLE IF NOT EXISTS exams
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  title TEXT NOT NULL,
+                  subject TEXT NOT NULL,
+                  grade TEXT NOT NULL,
+                  section TEXT NOT NULL,
+                  teacher_id INTEGER NOT NULL,
+                  duration INTEGER NOT NULL,
+                  total_marks INTEGER NOT NULL,
+                  start_time TIMESTAMP NOT NULL,
+                  end_time TIMESTAMP NOT NULL,
+                  questions TEXT,
+                  is_active BOOLEAN DEFAULT 1,
+                  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
+
+    # محاولات الطلاب
+    c.execute('''CREATE TABLE IF NOT EXISTS exam_attempts
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  exam_id INTEGER NOT NULL,
+                  student_id INTEGER NOT NULL,
+                  started_at TIMESTAMP,
+                  submitted_at TIMESTAMP,
+                  score REAL,
+                  status TEXT DEFAULT 'in_progress',
+                  UNIQUE(exam_id, student_id))''')
+
+    # إجابات الطلاب (سؤال واحد لكل صف)
+    c.execute('''CREATE TABLE IF NOT EXISTS exam_answers
+                 (exam_id INTEGER NOT NULL,
+                  student_id INTEGER NOT NULL,
+                  question_id TEXT NOT NULL,
+                  answer TEXT,
+                  saved_at TIMESTAMP,
+                  PRIMARY KEY (exam_id, student_id, question_id))''')
+
+    c.execute('''CREATE INDEX IF NOT EXISTS idx_exams_grade_section
+                 ON exams (grade, section, start_time)''')
+    c.execute('''CREATE INDEX IF NOT EXISTS idx_exam_attempts_status
+                 ON exam_attempts (exam_id, status)''')
+
+
+def parse_time(value):
+    # يقبل صيغة datetime-local من المتصفح وصيغة قاعدة البيانات
+    return datetime.fromisoformat(value.replace('T', ' '))
+
+
+def normalize_questions(questions):
+    # كل سؤال يحتاج معرفاً ثابتاً حتى تحفظ إجابته
+    normalized = []
+    for index, question in enumerate(questions):
+        question = dict(question)
+        question['id'] = str(question.get('id') or index + 1)
+        question['type'] = question.get('type', 'mcq')
+        question['marks'] = float(question.get('marks', 1))
+        normalized.append(question)
+    return normalized
+
+
+def create_exam(conn, teacher_id, title, subject, grade, section,
+                duration, total_marks, start_time, end_time, questions):
+    questions = normalize_questions(questions)
+    start = parse_time(start_time)
+    end = parse_time(end_time)
+    if end <= start:
+        raise ValueError('وقت انتهاء الاختبار يجب أن يكون بعد وقت البدء')
+
+    c = conn.cursor()
+    exam_id = database.insert(c, '''INSERT INTO exams
+                 (title, subject, grade, section, teacher_id, duration, total_marks,
+                  start_time, end_time, questions)
+                 VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+              (title, subject, grade, section, teacher_id, int(duration), int(total_marks),
+               start.strftime(TIME_FORMAT), end.strftime(TIME_FORMAT),
+               json.dumps(questions, ensure_ascii=False)))
+    conn.commit()
+    return exam_id
+
+
+# ورقة الاختبار المحللة تحفظ في الذاكرة مرة واحدة لكل اختبار
+class ExamPaper:
+    __slots__ = ('exam', 'questions', 'public_questions', 'answer_key', 'deadline')
+
+    def __init__(self, exam):
+        self.exam = exam
+        self.questions = json.loads(exam['questions'] or '[]')
+        # نسخة بدون الإجابات الصحيحة لعرضها على الطالب
+        self.public_questions = [
+            {k: v for k, v in q.items() if k != 'answer'} for q in self.questions
+        ]
+        # مفتاح الإجابة: (معرف السؤال، الإجابة الصحيحة، الدرجة) للأسئلة الموضوعية فقط
+        self.answer_key = [
+            (q['id'], normalize_answer(q.get('answer')), q['marks'])
+            for q in self.questions if q['type'] in OBJECTIVE_TYPES
+        ]
+        start = parse_time(exam['start_time'])
+        end = parse_time(exam['end_time'])
+        self.deadline = min(start + timedelta(minutes=exam['duration']), end)
+
+    def is_open(self, now=None):
+        now = now or datetime.now()
+        return parse_time(self.exam['start_time']) <= now <= self.deadline
+
+
+# الورقة في ذاكرة الكيانات المشتركة: أي تعديل على الاختبار يسجل cache.changed(c, cache.EXAM, exam_id)
+# فتحذف الورقة من كل العمال عند المزامنة التالية
+_paper_lock = threading.Lock()
+
+
+def get_paper(exam_id):
+    paper = cache.entities.get(cache.EXAM, exam_id, 'paper')
+    if paper is not None:
+        return paper
+
+    with _paper_lock:
+        # طالب آخر ربما حمّل الورقة أثناء انتظار القفل
+        paper = cache.entities.get(cache.EXAM, exam_id, 'paper')
+        if paper is not None:
+            return paper
+
+        with database.connection() as conn:
+            exam = database.query_one(conn, 'SELECT * FROM exams WHERE id = ? AND is_active = 1', (exam_id,))
+        if not exam:
+            return None
+
+        paper = ExamPaper(exam)
+        cache.entities.set(cache.EXAM, exam_id, 'paper', paper)
+        return paper
+
+
+def normalize_answer(value):
+    if value is None:
+        return None
+    return ' '.join(str(value).split()).lower()
+
+
+# تجميع الحفظ التلقائي في الذاكرة ثم كتابته دفعة واحدة
+class AnswerBuffer:
+    def __init__(self, flush_size=FLUSH_SIZE, flush_interval=FLUSH_INTERVAL):
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()
+        # كتابة واحدة في كل مرة: من ينتظر هذا القفل يعرف أن ما أُخذ من الذاكرة قبله قد كُتب
+        self.flush_lock = threading.Lock()
+        self.starts = {}
+        self.answers = {}
+        self.last_flush = time.monotonic()
+        self.thread = None
+
+    def start_attempt(self, exam_id, student_id):
+        with self.lock:
+            self.starts.setdefault((exam_id, student_id), datetime.now().strftime(TIME_FORMAT))
+        self._ensure_thread()
+
+    def save(self, exam_id, student_id, question_id, answer):
+        with self.lock:
+            self.starts.setdefault((exam_id, student_id), datetime.now().strftime(TIME_FORMAT))
+            self.answers[(exam_id, student_id, str(question_id))] = (
+                answer, datetime.now().strftime(TIME_FORMAT))
+            full = len(self.answers) >= self.flush_size
+        self._ensure_thread()
+        if full:
+            self.flush()
+
+    # عند عودة هذه الدالة تكون كل إجابة قُبلت قبل استدعائها مكتوبة في قاعدة البيانات،
+    # بما فيها ما أخذته كتابة أخرى من الذاكرة ولم تنهه بعد
+    def flush(self, conn=None):
+        with self.flush_lock:
+            with self.lock:
+                starts, self.starts = self.starts, {}
+                answers, self.answers = self.answers, {}
+                self.last_flush = time.monotonic()
+
+            if not starts and not answers:
+                return 0
+
+            own_conn = conn is None
+            if own_conn:
+                conn = database.connect()
+            try:
+                c = conn.cursor()
+                c.executemany('''INSERT INTO exam_attempts (exam_id, student_id, started_at)
+                                 VALUES (?, ?, ?) ON CONFLICT DO NOTHING''',
+                              [(eid, sid, started) for (eid, sid), started in starts.items()])
+                c.executemany(SAVE_ANSWER_SQL,
+                              [(eid, sid, qid, answer, saved_at)
+                               for (eid, sid, qid), (answer, saved_at) in answers.items()])
+                conn.commit()
+            except Exception:
+                # إعادة الإجابات إلى الذاكرة حتى لا تضيع، دون الكتابة فوق الأحدث منها
+                with self.lock:
+                    for key, value in starts.items():
+                        self.starts.setdefault(key, value)
+                    for key, value in answers.items():
+                        self.answers.setdefault(key, value)
+                raise
+            finally:
+                if own_conn:
+                    conn.close()
+            return len(answers)
+
+    def _ensure_thread(self):
+        if self.thread is not None and self.thread.is_alive():
+            return
+        with self.lock:
+            if self.thread is not None and self.thread.is_alive():
+                return
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except database.Error:
+                pass
+
+
+answer_buffer = AnswerBuffer()
+atexit.register(answer_buffer.flush)
+
+
+# حالة محاولة الطالب، أو None إذا لم تُسجل بعد
+def attempt_status(conn, exam_id, student_id):
+    return database.query_value(conn, '''SELECT status FROM exam_attempts
+                                         WHERE exam_id = ? AND student_id = ?''', (exam_id, student_id))
+
+
+def submit_attempt(conn, exam_id, student_id, answers):
+    if attempt_status(conn, exam_id, student_id) not in (None, 'in_progress'):
+        raise ValueError('تم تسليم هذا الاختبار مسبقاً')
+
+    paper = get_paper(exam_id)
+    now = datetime.now().strftime(TIME_FORMAT)
+
+    # كتابة كل ما في الذاكرة أولاً (وانتظار أي كتابة جارية) قبل إغلاق المحاولة،
+    # ثم إجابات التسليم فوقها لأنها الأحدث دائماً
+    answer_buffer.flush(conn)
+
+    c = conn.cursor()
+    c.execute('''INSERT INTO exam_attempts (exam_id, student_id, started_at)
+                 VALUES (?, ?, ?) ON CONFLICT DO NOTHING''', (exam_id, student_id, now))
+    c.executemany(SAVE_ANSWER_SQL,
+                  [(exam_id, student_id, str(qid), answer, now) for qid, answer in answers.items()])
+    c.execute('''UPDATE exam_attempts SET status = 'submitted', submitted_at = ?
+                 WHERE exam_id = ? AND student_id = ? AND status = 'in_progress' ''',
+              (now, exam_id, student_id))
+    conn.commit()
+
+    grade_pending_attempts(conn, paper)
+
+
+# تصحيح كل المحاولات المسلمة للاختبار في مرور واحد
+def grade_pending_attempts(conn, paper):
+    exam_id = paper.exam['id']
+    c = conn.cursor()
+    key = {qid: (answer, marks) for qid, answer, marks in paper.answer_key}
+
+    # المحاولات وإجاباتها بطلب واحد: محاولة تُسلم أثناء التصحيح إما تظهر كاملة أو لا تظهر
+    # (تبقى 'submitted' وتصحح في المرة التالية)
+    c.execute('''SELECT att.student_id, ans.question_id, ans.answer
+                 FROM exam_attempts att
+                 LEFT JOIN exam_answers ans ON ans.exam_id = att.exam_id
+                                           AND ans.student_id = att.student_id
+                 WHERE att.exam_id = ? AND att.status = 'submitted' ''', (exam_id,))
+    scores = {}
+    for student_id, question_id, answer in c.fetchall():
+        scores.setdefault(student_id, 0.0)
+        expected = key.get(question_id)
+        if expected and expected[0] is not None and normalize_answer(answer) == expected[0]:
+            scores[student_id] += expected[1]
+    if not scores:
+        return 0
+
+    # الاختبارات التي تحتوي أسئلة مقالية تبقى بانتظار مراجعة المعلم (review_attempt)
+    has_essay = len(paper.answer_key) < len(paper.questions)
+    status = 'pending_review' if has_essay else 'graded'
+
+    c.executemany('''UPDATE exam_attempts SET score = ?, status = ?
+                     WHERE exam_id = ? AND student_id = ? AND status = 'submitted' ''',
+                  [(score, status, exam_id, student_id) for student_id, score in scores.items()])
+    conn.commit()
+    return len(scores)
+
+
+def essay_questions(paper):
+    return [q for q in paper.questions if q['type'] not in OBJECTIVE_TYPES]
+
+
+# الأسئلة المقالية مع إجابات طالب واحد عليها لعرضها على المعلم
+def essay_answers(conn, paper, student_id):
+    answers = {row.question_id: row.answer for row in database.query_all(
+        conn, '''SELECT question_id, answer FROM exam_answers
+                 WHERE exam_id = ? AND student_id = ?''', (paper.exam['id'], student_id))}
+    return [{'id': q['id'], 'text': q.get('text', ''), 'marks': q['marks'], 'answer': answers.get(q['id'])}
+            for q in essay_questions(paper)]
+
+
+# درجات المعلم للأسئلة المقالية تضاف إلى درجة التصحيح الآلي وتغلق المحاولة
+def review_attempt(conn, paper, student_id, marks):
+    limits = {q['id']: q['marks'] for q in essay_questions(paper)}
+    total = 0.0
+    for question_id in limits:
+        value = float(marks.get(question_id, 0) or 0)
+        if not 0 <= value <= limits[question_id]:
+            raise ValueError('درجة السؤال %s يجب أن تكون بين 0 و %s' % (question_id, limits[question_id]))
+        total += value
+
+    c = conn.cursor()
+    c.execute('''UPDATE exam_attempts SET score = COALESCE(score, 0) + ?, status = 'graded'
+                 WHERE exam_id = ? AND student_id = ? AND status = 'pending_review' ''',
+              (total, paper.exam['id'], student_id))
+    if c.rowcount != 1:
+        conn.rollback()
+        raise ValueError('المحاولة ليست بانتظار المراجعة')
+    conn.commit()
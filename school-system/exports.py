@@ -0,0 +1,280 @@
+﻿import io
+import re
+import csv
+import zipfile
+from functools import lru_cache
+from itertools import groupby
+from xml.sax.saxutils import escape
+
+import database
+
+# عدد الصفوف في كل دفعة ترسل إلى المتصفح
+BATCH_SIZE = 500
+
+FORMATS = {
+    'csv': 'text/csv; charset=utf-8',
+    'xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+}
+
+
+class ExportError(Exception):
+    pass
+
+
+# كل تصدير = عناوين الأعمدة + مولد صفوف يفتح اتصاله ويغلقه بنفسه
+class Export:
+    def __init__(self, name, header, rows):
+        self.name = name
+        self.header = header
+        self.rows = rows
+
+    def filename(self, fmt):
+        return '%s.%s' % (self.name, fmt)
+
+    def stream(self, fmt):
+        if fmt == 'csv':
+            return csv_stream(self.header, self.rows)
+        if fmt == 'xlsx':
+            return xlsx_stream(self.header, self.rows)
+        raise ExportError('صيغة غير مدعومة: ' + fmt)
+
+
+# CSV: النص الذي يبدأ بهذه الرموز ينفذه Excel كمعادلة
+FORMULA_PREFIXES = ('=', '+', '-', '@', '\t', '\r')
+
+
+def csv_cell(value):
+    if isinstance(value, str) and value.startswith(FORMULA_PREFIXES):
+        return "'" + value
+    return value
+
+
+def csv_stream(header, rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    # BOM حتى يعرض Excel النص العربي بشكل صحيح
+    buffer.write('\ufeff')
+    writer.writerow(header)
+    for count, row in enumerate(rows, 1):
+        writer.writerow([csv_cell(value) for value in row])
+        if count % BATCH_SIZE == 0:
+            yield buffer.getvalue().encode('utf-8')
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue().encode('utf-8')
+
+
+# XLSX: ملف zip يكتب على التوالي دون الرجوع للخلف (بدون مكتبات إضافية)
+class _ChunkWriter:
+    def __init__(self):
+        self.chunks = []
+        self.offset = 0
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.offset += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.offset
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+_CONTENT_TYPES = '''<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">
+<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>
+<Default Extension="xml" ContentType="application/xml"/>
+<Override PartName="/xl/workbook.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>
+<Override PartName="/xl/worksheets/sheet1.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>
+</Types>'''
+
+_ROOT_RELS = '''<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">
+<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="xl/workbook.xml"/>
+</Relationships>'''
+
+_WORKBOOK = '''<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">
+<sheets><sheet name="Sheet1" sheetId="1" r:id="rId1"/></sheets>
+</workbook>'''
+
+_WORKBOOK_RELS = '''<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">
+<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" Target="worksheets/sheet1.xml"/>
+</Relationships>'''
+
+_SHEET_START = '''<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">
+<sheetViews><sheetView workbookViewId="0" rightToLeft="1"/></sheetViews>
+<sheetData>'''
+
+_SHEET_END = '</sheetData></worksheet>'
+
+# محارف التحكم غير مسموحة في XML
+_INVALID_XML = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f]')
+
+
+# حرف العمود من رقمه (0 -> A، 26 -> AA)؛ دالة نقية فالتخزين آمن بين الخيوط
+@lru_cache(maxsize=None)
+def _column(index):
+    n = index + 1
+    name = ''
+    while n:
+        n, remainder = divmod(n - 1, 26)
+        name = chr(65 + remainder) + name
+    return name
+
+
+def _cell(ref, value):
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return '<c r="%s"><v>%s</v></c>' % (ref, value)
+    text = escape(_INVALID_XML.sub('', str(value)))
+    return '<c r="%s" t="inlineStr"><is><t xml:space="preserve">%s</t></is></c>' % (ref, text)
+
+
+def _row_xml(number, row):
+    # الخلايا الفارغة لا تكتب (سجل درجات المدرسة معظمه فارغ)
+    cells = ''.join(_cell('%s%d' % (_column(index), number), value)
+                    for index, value in enumerate(row) if value is not None and value != '')
+    return '<row r="%d">%s</row>' % (number, cells)
+
+
+def xlsx_stream(header, rows):
+    output = _ChunkWriter()
+    with zipfile.ZipFile(output, 'w', zipfile.ZIP_DEFLATED) as archive:
+        archive.writestr('[Content_Types].xml', _CONTENT_TYPES)
+        archive.writestr('_rels/.rels', _ROOT_RELS)
+        archive.writestr('xl/workbook.xml', _WORKBOOK)
+        archive.writestr('xl/_rels/workbook.xml.rels', _WORKBOOK_RELS)
+        with archive.open('xl/worksheets/sheet1.xml', 'w', force_zip64=True) as sheet:
+            sheet.write((_SHEET_START + _row_xml(1, header)).encode('utf-8'))
+            for number, row in enumerate(rows, 2):
+                sheet.write(_row_xml(number, row).encode('utf-8'))
+                if number % BATCH_SIZE == 0:
+                    yield output.take()
+            sheet.write(_SHEET_END.encode('utf-8'))
+    yield output.take()
+
+
+def _stream_rows(sql, params):
+    conn = database.connect()
+    try:
+        for row in database.stream(conn, sql, params, BATCH_SIZE):
+            yield tuple(row)
+    finally:
+        conn.close()
+
+
+# قائمة المستخدمين حسب الصف والشعبة
+def roster(user_type='student', grade=None, section=None):
+    query = '''SELECT id, name, username, grade, section, subject, is_active, created_at
+               FROM users WHERE user_type = ?'''
+    params = [user_type]
+    name = 'roster-' + user_type
+    if grade:
+        query += ' AND grade = ?'
+        params.append(grade)
+        name += '-' + grade
+    if section:
+        query += ' AND section = ?'
+        params.append(section)
+        name += '-' + section
+    query += ' ORDER BY grade, section, name, id'
+    header = ['المعرف', 'الاسم', 'اسم المستخدم', 'الصف', 'الشعبة', 'المادة', 'نشط', 'تاريخ التسجيل']
+    return Export(name, header, _stream_rows(query, params))
+
+
+# سجل الدرجات: طالب في كل صف وواجب في كل عمود
+# الواجبات (الأعمدة) تحمل أولاً، ثم تقرأ درجات الطلاب مرتبة حسب الطالب على دفعات
+def gradebook(grade=None, section=None, teacher_id=None, room=None, since=None, until=None):
+    assignments_sql = '''SELECT a.id, a.title, a.grade, a.section, a.total_marks
+                         FROM assignments a WHERE 1 = 1'''
+    students_sql = '''SELECT u.id, u.name, u.grade, u.section, s.assignment_id, s.grade as score
+                      FROM users u'''
+    students_where = " WHERE u.user_type = 'student'"
+    assignment_params = []
+    student_params = []
+    name = 'gradebook'
+
+    if room is not None:
+        # واجبات معلم الغرفة لصفها وشعبتها، وطلاب الغرفة فقط
+        assignments_sql += ''' AND (a.room_id = ? OR (a.room_id IS NULL AND a.teacher_id = ?
+                               AND a.grade = ? AND a.section = ?))'''
+        assignment_params += [room.id, room.teacher_id, room.grade, room.section]
+        students_sql += ' JOIN room_students rs ON rs.student_id = u.id AND rs.room_id = ?'
+        student_params.append(room.id)
+        name += '-room-%d' % room.id
+    else:
+        if grade:
+            assignments_sql += ' AND a.grade = ?'
+            assignment_params.append(grade)
+            students_where += ' AND u.grade = ?'
+            name += '-' + grade
+        if section:
+            assignments_sql += ' AND a.section = ?'
+            assignment_params.append(section)
+            students_where += ' AND u.section = ?'
+            name += '-' + section
+    if teacher_id is not None:
+        assignments_sql += ' AND a.teacher_id = ?'
+        assignment_params.append(teacher_id)
+    if since:
+        assignments_sql += ' AND a.due_date >= ?'
+        assignment_params.append(since)
+    if until:
+        assignments_sql += ' AND a.due_date <= ?'
+        assignment_params.append(until)
+    assignments_sql += ' ORDER BY a.grade, a.section, a.due_date, a.id'
+
+    conn = database.connect()
+    try:
+        assignments = database.query_all(conn, assignments_sql, assignment_params)
+    finally:
+        conn.close()
+
+    columns = {assignment.id: position for position, assignment in enumerate(assignments)}
+    header = ['المعرف', 'الاسم', 'الصف', 'الشعبة']
+    header += ['%s (%s/%s) /%s' % (a.title, a.grade, a.section, a.total_marks) for a in assignments]
+
+    students_sql += ''' LEFT JOIN assignment_submissions s ON s.student_id = u.id
+                        AND s.status = 'graded' '''
+    if room is None:
+        student_params += [value for value in (grade, section) if value]
+        # طلاب صفوف الواجبات المختارة فقط (مثلاً صفوف المعلم عند تحديد teacher_id)
+        classes = sorted({(a.grade, a.section) for a in assignments})
+        if classes:
+            students_where += ' AND (%s)' % ' OR '.join(['(u.grade = ? AND u.section = ?)'] * len(classes))
+            for class_grade, class_section in classes:
+                student_params += [class_grade, class_section]
+        else:
+            students_where += ' AND 1 = 0'
+    students_sql += students_where + ' ORDER BY u.grade, u.section, u.name, u.id'
+
+    def rows():
+        for (student_id, student_name, student_grade, student_section), group in groupby(
+                _stream_rows(students_sql, student_params), key=lambda row: row[:4]):
+            scores = [None] * len(columns)
+            for row in group:
+                position = columns.get(row[4])
+                if position is not None:
+                    scores[position] = row[5]
+            yield [student_id, student_name, student_grade, student_section] + scores
+
+    return Export(name, header, rows())
+
+
+# سجل دردشة غرفة كاملاً بترتيب الإرسال
+def chat_transcript(room_id):
+    query = '''SELECT cm.id, cm.sent_at, cm.user_name, u.user_type, cm.message_type, cm.message
+               FROM chat_messages cm
+               LEFT JOIN users u ON cm.user_id = u.id
+               WHERE cm.room_id = ? ORDER BY cm.id'''
+    header = ['المعرف', 'الوقت', 'المرسل', 'النوع', 'نوع الرسالة', 'الرسالة']
+    return Export('chat-room-%d' % room_id, header, _stream_rows(query, (room_id,)))
@@ -0,0 +1,81 @@
+﻿import json
+from datetime import date, datetime, time
+from decimal import Decimal
+
+from flask import current_app
+
+import database
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# عدد العناصر في كل دفعة عند ترميز القوائم الكبيرة على التوالي
+STREAM_BATCH = 500
+
+
+# الأنواع غير المدعومة مباشرة، بنفس الصيغة المخزنة في قاعدة البيانات
+def default(o):
+    if isinstance(o, database.Row):
+        return o.as_dict()
+    if isinstance(o, datetime):
+        return o.strftime(TIME_FORMAT)
+    if isinstance(o, (date, time)):
+        return o.isoformat()
+    if isinstance(o, Decimal):
+        return float(o)
+    if isinstance(o, (set, frozenset)):
+        return list(o)
+    if hasattr(o, '__html__'):
+        return str(o.__html__())
+    raise TypeError('Object of type %s is not JSON serializable' % type(o).__name__)
+
+
+if orjson is not None:
+    backend = 'orjson'
+    # التواريخ تمر إلى default حتى تبقى الصيغة واحدة مع المكتبة القياسية
+    _OPTIONS = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+
+    def dumps(obj):
+        return orjson.dumps(obj, default=default, option=_OPTIONS)
+else:
+    backend = 'json'
+    _encoder = json.JSONEncoder(default=default, ensure_ascii=False, separators=(',', ':'))
+
+    def dumps(obj):
+        return _encoder.encode(obj).encode('utf-8')
+
+
+# بديل flask.jsonify: ترميز مضغوط وأسرع
+def jsonify(*args, **kwargs):
+    if args and kwargs:
+        raise TypeError('jsonify() behavior undefined when passed both args and kwargs')
+    if len(args) == 1:
+        data = args[0]
+    else:
+        data = args or kwargs
+    return current_app.response_class(dumps(data), mimetype='application/json')
+
+
+# قائمة كبيرة داخل كائن: {"success": true, ..., "key": [ ... ]} ترمّز وترسل على دفعات
+def _stream_array(fields, key, items):
+    head = dumps(fields)
+    yield head[:-1] + (b',' if fields else b'') + dumps(key) + b':['
+    batch = []
+    first = True
+    for item in items:
+        batch.append(dumps(item))
+        if len(batch) >= STREAM_BATCH:
+            yield (b'' if first else b',') + b','.join(batch)
+            batch = []
+            first = False
+    if batch:
+        yield (b'' if first else b',') + b','.join(batch)
+    yield b']}'
+
+
+def stream_jsonify(key, items, **fields):
+    return current_app.response_class(_stream_array(fields, key, items), mimetype='application/json')
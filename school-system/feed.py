@@ -0,0 +1,82 @@
+﻿import database
+
+# أقصى عدد من الأحداث المحفوظة لكل مستخدم
+FEED_LIMIT = 200
+PAGE_SIZE = 20
+
+# أنواع الأحداث
+NEW_ASSIGNMENT = 'new_assignment'
+GRADE_POSTED = 'grade_posted'
+NEW_SUBMISSION = 'new_submission'
+ROOM_JOINED = 'room_joined'
+
+
+def init_feed_tables(c):
+    c.execute('''CREATE TABLE IF NOT EXISTS activity_feed
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  user_id INTEGER NOT NULL,
+                  event_type TEXT NOT NULL,
+                  title TEXT NOT NULL,
+                  body TEXT,
+                  link TEXT,
+                  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
+
+    # قراءة صفحة من أحداث المستخدم = مسح مدى واحد على هذا الفهرس
+    c.execute('''CREATE INDEX IF NOT EXISTS idx_activity_feed_user
+                 ON activity_feed (user_id, id)''')
+
+
+# حذف الأحداث الأقدم من FEED_LIMIT لكل مستخدم في المجموعة
+def _trim(c, users_sql, params):
+    c.execute('''DELETE FROM activity_feed WHERE id IN
+                 (SELECT id FROM
+                     (SELECT id, ROW_NUMBER() OVER (PARTITION BY user_id ORDER BY id DESC) as position
+                      FROM activity_feed WHERE user_id IN (%s)) ranked
+                  WHERE position > ?)''' % users_sql, tuple(params) + (FEED_LIMIT,))
+
+
+def publish(c, user_ids, event_type, title, body=None, link=None):
+    user_ids = list(user_ids)
+    if not user_ids:
+        return
+    c.executemany('''INSERT INTO activity_feed (user_id, event_type, title, body, link)
+                     VALUES (?, ?, ?, ?, ?)''',
+                  [(user_id, event_type, title, body, link) for user_id in user_ids])
+    _trim(c, ', '.join('?' * len(user_ids)), user_ids)
+
+
+# أحداث مختلفة لمستخدمين مختلفين: [(user_id, event_type, title, body, link)]
+def publish_many(c, events):
+    events = list(events)
+    if not events:
+        return
+    c.executemany('''INSERT INTO activity_feed (user_id, event_type, title, body, link)
+                     VALUES (?, ?, ?, ?, ?)''', events)
+    user_ids = sorted({event[0] for event in events})
+    _trim(c, ', '.join('?' * len(user_ids)), user_ids)
+
+
+# نشر حدث لكل طلاب الصف/الشعبة بإدخال واحد
+def publish_to_grade(c, grade, section, event_type, title, body=None, link=None):
+    students_sql = '''SELECT id FROM users
+                      WHERE user_type = 'student' AND grade = ? AND section = ? AND is_active = 1'''
+    c.execute('''INSERT INTO activity_feed (user_id, event_type, title, body, link)
+                 SELECT id, ?, ?, ?, ? FROM users
+                 WHERE user_type = 'student' AND grade = ? AND section = ? AND is_active = 1''',
+              (event_type, title, body, link, grade, section))
+    _trim(c, students_sql, (grade, section))
+
+
+# صفحة من أحداث المستخدم، الأحدث أولاً؛ before هو معرف آخر حدث في الصفحة السابقة
+def get_feed(conn, user_id, before=None, limit=PAGE_SIZE):
+    limit = max(1, min(int(limit), 100))
+    if before:
+        items = database.query_all(conn, '''SELECT id, event_type, title, body, link, created_at
+                                            FROM activity_feed WHERE user_id = ? AND id < ?
+                                            ORDER BY id DESC LIMIT ?''', (user_id, before, limit))
+    else:
+        items = database.query_all(conn, '''SELECT id, event_type, title, body, link, created_at
+                                            FROM activity_feed WHERE user_id = ?
+                                            ORDER BY id DESC LIMIT ?''', (user_id, limit))
+    next_cursor = items[-1].id if len(items) == limit else None
+    return items, next_cursor
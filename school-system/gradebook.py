@@ -0,0 +1,234 @@
+﻿import json
+from datetime import datetime
+from itertools import groupby
+
+import cache
+import database
+
+# عدد فئات المدرج التكراري (كل فئة 10%)
+HISTOGRAM_BINS = 10
+
+# عدد الواجبات في كل دفعة عند إعادة الحساب الكاملة
+REBUILD_BATCH = 500
+
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+# جدول الإحصائيات المحسوبة مسبقاً لكل واجب
+def init_gradebook_tables(c):
+    c.execute('''CREATE TABLE IF NOT EXISTS assignment_stats
+                 (assignment_id INTEGER PRIMARY KEY,
+                  graded_count INTEGER NOT NULL DEFAULT 0,
+                  mean REAL,
+                  median REAL,
+                  p25 REAL,
+                  p75 REAL,
+                  p90 REAL,
+                  min_score REAL,
+                  max_score REAL,
+                  histogram TEXT,
+                  updated_at TIMESTAMP)''')
+
+    c.execute('''CREATE INDEX IF NOT EXISTS idx_submissions_assignment_status
+                 ON assignment_submissions (assignment_id, status)''')
+
+    # سجل الدرجات لكل طالب (التصدير وصفحة واجبات الطالب)
+    c.execute('''CREATE INDEX IF NOT EXISTS idx_submissions_student
+                 ON assignment_submissions (student_id, assignment_id)''')
+
+
+def percentile(sorted_values, p):
+    # استيفاء خطي بين أقرب قيمتين (نفس طريقة Excel و numpy الافتراضية)
+    if not sorted_values:
+        return None
+    position = (len(sorted_values) - 1) * p / 100.0
+    lower = int(position)
+    upper = min(lower + 1, len(sorted_values) - 1)
+    fraction = position - lower
+    return sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * fraction
+
+
+def histogram(percentages):
+    bins = [0] * HISTOGRAM_BINS
+    for value in percentages:
+        index = min(int(value * HISTOGRAM_BINS / 100), HISTOGRAM_BINS - 1)
+        bins[max(index, 0)] += 1
+    return bins
+
+
+# ملخص إحصائي لقائمة درجات مطبّعة كنسب مئوية
+def summarize(percentages):
+    values = sorted(percentages)
+    if not values:
+        return {'graded_count': 0, 'mean': None, 'median': None, 'p25': None,
+                'p75': None, 'p90': None, 'min_score': None, 'max_score': None,
+                'histogram': [0] * HISTOGRAM_BINS}
+    return {
+        'graded_count': len(values),
+        'mean': round(sum(values) / len(values), 2),
+        'median': round(percentile(values, 50), 2),
+        'p25': round(percentile(values, 25), 2),
+        'p75': round(percentile(values, 75), 2),
+        'p90': round(percentile(values, 90), 2),
+        'min_score': values[0],
+        'max_score': values[-1],
+        'histogram': histogram(values),
+    }
+
+
+def normalize(grade, total_marks):
+    if not total_marks:
+        return 0.0
+    return round(grade * 100.0 / total_marks, 2)
+
+
+# تحديث إحصائيات واجب واحد بعد كل تصحيح
+def refresh_assignment_stats(conn, assignment_id):
+    c = conn.cursor()
+    c.execute('''SELECT s.grade, a.total_marks FROM assignment_submissions s
+                 JOIN assignments a ON s.assignment_id = a.id
+                 WHERE s.assignment_id = ? AND s.status = 'graded' AND s.grade IS NOT NULL''',
+              (assignment_id,))
+    stats = summarize([normalize(grade, total) for grade, total in c.fetchall()])
+    _store_stats(c, [(assignment_id, stats)])
+    cache.changed(c, cache.ASSIGNMENT, assignment_id)
+    conn.commit()
+    return stats
+
+
+# إعادة بناء الإحصائيات لكل الواجبات بطلب واحد
+def rebuild_all_stats(conn, progress=None):
+    c = conn.cursor()
+    grades = {}
+    c.execute('''SELECT a.id, s.grade, a.total_marks FROM assignments a
+                 LEFT JOIN assignment_submissions s ON s.assignment_id = a.id
+                      AND s.status = 'graded' AND s.grade IS NOT NULL''')
+    for assignment_id, grade, total in c.fetchall():
+        values = grades.setdefault(assignment_id, [])
+        if grade is not None:
+            values.append(normalize(grade, total))
+    # الحساب والكتابة على دفعات حتى يظهر التقدم في المهام الطويلة
+    items = list(grades.items())
+    for start in range(0, len(items), REBUILD_BATCH):
+        batch = items[start:start + REBUILD_BATCH]
+        _store_stats(c, [(assignment_id, summarize(values)) for assignment_id, values in batch])
+        if progress:
+            progress((start + len(batch)) / len(items), 'إعادة حساب إحصائيات الواجبات')
+    cache.changed(c, cache.ASSIGNMENT)
+    conn.commit()
+    return len(grades)
+
+
+def _store_stats(c, items):
+    now = datetime.now().strftime(TIME_FORMAT)
+    c.executemany('''INSERT INTO assignment_stats
+                     (assignment_id, graded_count, mean, median, p25, p75, p90,
+                      min_score, max_score, histogram, updated_at)
+                     VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                     ON CONFLICT (assignment_id) DO UPDATE SET
+                      graded_count = excluded.graded_count, mean = excluded.mean,
+                      median = excluded.median, p25 = excluded.p25, p75 = excluded.p75,
+                      p90 = excluded.p90, min_score = excluded.min_score,
+                      max_score = excluded.max_score, histogram = excluded.histogram,
+                      updated_at = excluded.updated_at''',
+                  [(assignment_id, s['graded_count'], s['mean'], s['median'], s['p25'],
+                    s['p75'], s['p90'], s['min_score'], s['max_score'],
+                    json.dumps(s['histogram']), now)
+                   for assignment_id, s in items])
+
+
+def get_assignment_stats(conn, assignment_id):
+    return cache.get_or_load(cache.ASSIGNMENT, assignment_id, 'stats',
+                             lambda: _load_stats(conn, assignment_id))
+
+
+def _load_stats(conn, assignment_id):
+    row = database.query_one(conn, 'SELECT * FROM assignment_stats WHERE assignment_id = ?',
+                             (assignment_id,))
+    if not row:
+        return refresh_assignment_stats(conn, assignment_id)
+    stats = row.as_dict()
+    stats['histogram'] = json.loads(stats['histogram'] or '[]')
+    return stats
+
+
+def trend_slope(points):
+    # ميل خط الانحدار (نقطة مئوية لكل واجب)
+    n = len(points)
+    if n < 2:
+        return None
+    mean_x = (n - 1) / 2.0
+    mean_y = sum(points) / n
+    numerator = sum((x - mean_x) * (y - mean_y) for x, y in enumerate(points))
+    denominator = sum((x - mean_x) ** 2 for x in range(n))
+    return round(numerator / denominator, 2)
+
+
+# الصفوف: (الصف، الشعبة، الواجب، ...، الطالب، الدرجة) مرتبة حسب موعد التسليم
+REPORT_SQL = '''SELECT a.grade, a.section, a.id, a.title, a.subject, a.due_date, a.total_marks,
+                s.student_id, u.name, s.grade
+                FROM assignments a
+                LEFT JOIN assignment_submissions s ON s.assignment_id = a.id
+                     AND s.status = 'graded' AND s.grade IS NOT NULL
+                LEFT JOIN users u ON s.student_id = u.id'''
+
+
+# تقرير الصف/الشعبة: إحصائيات كل واجب، التوزيع العام، واتجاه كل طالب
+def class_report(conn, grade, section, teacher_id=None, room_id=None):
+    c = conn.cursor()
+    query = REPORT_SQL + ' WHERE a.grade = ? AND a.section = ?'
+    params = [grade, section]
+    if teacher_id is not None:
+        query += ' AND a.teacher_id = ?'
+        params.append(teacher_id)
+    if room_id is not None:
+        query += ' AND a.room_id = ?'
+        params.append(room_id)
+    query += ' ORDER BY a.due_date, a.id'
+    c.execute(query, params)
+    return _build_report(grade, section, c.fetchall())
+
+
+# نفس تقرير الصف لكل صفوف المدرسة باستعلام واحد
+def school_report(conn):
+    c = conn.cursor()
+    c.execute(REPORT_SQL + ' ORDER BY a.grade, a.section, a.due_date, a.id')
+    return [_build_report(grade, section, rows)
+            for (grade, section), rows in groupby(c.fetchall(), key=lambda row: row[:2])]
+
+
+def _build_report(grade, section, rows):
+    assignments = {}
+    students = {}
+    all_scores = []
+    for (_, _, assignment_id, title, subject, due_date, total_marks,
+         student_id, student_name, score) in rows:
+        assignment = assignments.get(assignment_id)
+        if assignment is None:
+            assignment = assignments[assignment_id] = {
+                'id': assignment_id, 'title': title, 'subject': subject,
+                'due_date': due_date, 'total_marks': total_marks, 'scores': []}
+        if student_id is None:
+            continue
+        percentage = normalize(score, total_marks)
+        assignment['scores'].append(percentage)
+        all_scores.append(percentage)
+        student = students.setdefault(student_id, {'student_id': student_id,
+                                                   'name': student_name, 'scores': []})
+        student['scores'].append(percentage)
+
+    for assignment in assignments.values():
+        assignment.update(summarize(assignment.pop('scores')))
+
+    for student in students.values():
+        scores = student['scores']
+        student['average'] = round(sum(scores) / len(scores), 2)
+        student['trend'] = trend_slope(scores)
+
+    return {
+        'grade': grade,
+        'section': section,
+        'overall': summarize(all_scores),
+        'assignments': list(assignments.values()),
+        'students': sorted(students.values(), key=lambda s: s['name'] or ''),
+    }
@@ -0,0 +1,112 @@
+﻿import cache
+import database
+import feed
+import gradebook
+import submissions
+
+# أقصى عدد تصحيحات في طلب واحد (تحت حد المتغيرات في SQLite)
+MAX_BATCH = 500
+QUEUE_LIMIT = 100
+
+
+class GradingError(Exception):
+    pass
+
+
+def init_grading_tables(c):
+    # قائمة الحلول غير المصححة = مسح مدى status = 'submitted' على هذا الفهرس
+    c.execute('''CREATE INDEX IF NOT EXISTS idx_submissions_status_assignment
+                 ON assignment_submissions (status, assignment_id)''')
+
+
+# [{"submission_id": 1, "grade": 8, "feedback": "..."}] -> [(1, 8, '...')]
+def parse_items(data):
+    if not isinstance(data, list) or not data:
+        raise GradingError('لا توجد درجات')
+    if len(data) > MAX_BATCH:
+        raise GradingError('الحد الأقصى %d حلاً في الطلب الواحد' % MAX_BATCH)
+    items = []
+    for entry in data:
+        try:
+            items.append((int(entry['submission_id']), int(entry['grade']),
+                          str(entry.get('feedback') or '')))
+        except (KeyError, TypeError, ValueError):
+            raise GradingError('بيانات غير صالحة: %r' % (entry,)) from None
+    ids = [submission_id for submission_id, _, _ in items]
+    if len(set(ids)) != len(ids):
+        raise GradingError('حل مكرر في الطلب')
+    return items
+
+
+# تصحيح عدة حلول في معاملة واحدة: استعلام واحد للتحقق من الملكية وتحديث واحد مجمع
+def grade_many(conn, teacher_id, items):
+    ids = [submission_id for submission_id, _, _ in items]
+    c = conn.cursor()
+    c.execute('''SELECT s.id, s.student_id, a.id as assignment_id, a.title, a.total_marks
+                 FROM assignment_submissions s
+                 JOIN assignments a ON a.id = s.assignment_id
+                 WHERE a.teacher_id = ? AND s.id IN (%s)''' % ', '.join('?' * len(ids)),
+              [teacher_id] + ids)
+    owned = {row.id: row for row in database.fetch_all(c)}
+
+    missing = [submission_id for submission_id in ids if submission_id not in owned]
+    if missing:
+        raise GradingError('غير مصرح لك بتصحيح الحلول: %s' % ', '.join(map(str, missing)))
+    invalid = [submission_id for submission_id, grade, _ in items
+               if not 0 <= grade <= owned[submission_id].total_marks]
+    if invalid:
+        raise GradingError('درجة خارج المدى للحلول: %s' % ', '.join(map(str, invalid)))
+
+    try:
+        c.executemany('''UPDATE assignment_submissions
+                         SET grade = ?, feedback = ?, status = 'graded', graded_at = CURRENT_TIMESTAMP
+                         WHERE id = ?''',
+                      [(grade, feedback, submission_id) for submission_id, grade, feedback in items])
+        feed.publish_many(c, [(owned[submission_id].student_id, feed.GRADE_POSTED,
+                               f'تم تصحيح: {owned[submission_id].title}',
+                               f'الدرجة: {grade}/{owned[submission_id].total_marks}',
+                               '/student/assignments')
+                              for submission_id, grade, _ in items])
+        for student_id in {row.student_id for row in owned.values()}:
+            cache.changed(c, cache.USER, student_id)
+        cache.changed(c, cache.USER, teacher_id)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+    # إحصائيات الواجبات المتأثرة فقط
+    assignment_ids = sorted({row.assignment_id for row in owned.values()})
+    for assignment_id in assignment_ids:
+        gradebook.refresh_assignment_stats(conn, assignment_id)
+    return len(items), assignment_ids
+
+
+# الحلول غير المصححة في كل واجبات المعلم، الأقدم أولاً
+def ungraded_queue(conn, teacher_id, assignment_id=None, limit=QUEUE_LIMIT):
+    query = '''SELECT s.id, s.assignment_id, s.student_id, s.submitted_at, u.name as student_name,
+               a.title, a.subject, a.grade as class_grade, a.section, a.total_marks, a.due_date,
+               substr(s.solution, 1, ?) as preview
+               FROM assignments a
+               JOIN assignment_submissions s ON s.assignment_id = a.id AND s.status = 'submitted'
+               JOIN users u ON u.id = s.student_id
+               WHERE a.teacher_id = ?'''
+    params = [submissions.PREVIEW_LENGTH, teacher_id]
+    if assignment_id is not None:
+        query += ' AND a.id = ?'
+        params.append(assignment_id)
+    query += ' ORDER BY s.submitted_at, s.id LIMIT ?'
+    params.append(limit)
+    return database.query_all(conn, query, params)
+
+
+# عدد الحلول غير المصححة لكل واجب
+def queue_summary(conn, teacher_id):
+    return database.query_all(conn, '''SELECT a.id, a.title, a.grade, a.section, a.due_date,
+                                       COUNT(s.id) as ungraded_count
+                                       FROM assignments a
+                                       JOIN assignment_submissions s ON s.assignment_id = a.id
+                                            AND s.status = 'submitted'
+                                       WHERE a.teacher_id = ?
+                                       GROUP BY a.id, a.title, a.grade, a.section, a.due_date
+                                       ORDER BY a.due_date, a.id''', (teacher_id,))
@@ -109,7 +109,7 @@ class Exam(db.Model):
     total_marks = db.Column(db.Integer, nullable=False)
     start_time = db.Column(db.DateTime, nullable=False)
     end_time = db.Column(db.DateTime, nullable=False)
-    questions = db.Column(db.Text)  JSON format
+    questions = db.Column(db.Text)  # JSON format
     is_active = db.Column(db.Boolean, default=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
@@ -0,0 +1,332 @@
+﻿import os
+import sys
+import json
+import time
+import socket
+import signal
+import argparse
+import traceback
+from datetime import datetime, timedelta
+from concurrent.futures import ProcessPoolExecutor
+
+import database
+from config import Config
+
+# حالات المهمة
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# أنواع المهام المسجلة: الاسم -> الدالة
+handlers = {}
+
+
+class JobError(Exception):
+    pass
+
+
+def handler(kind):
+    def register(function):
+        handlers[kind] = function
+        return function
+    return register
+
+
+def init_job_tables(c):
+    c.execute('''CREATE TABLE IF NOT EXISTS jobs
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  kind TEXT NOT NULL,
+                  payload TEXT,
+                  status TEXT DEFAULT 'queued',
+                  attempts INTEGER DEFAULT 0,
+                  max_attempts INTEGER DEFAULT 3,
+                  run_after TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                  lease_until TIMESTAMP,
+                  worker TEXT,
+                  progress REAL DEFAULT 0,
+                  message TEXT,
+                  result TEXT,
+                  error TEXT,
+                  created_by INTEGER,
+                  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                  started_at TIMESTAMP,
+                  finished_at TIMESTAMP)''')
+
+    # اختيار المهمة التالية = مسح مدى على هذا الفهرس
+    c.execute('''CREATE INDEX IF NOT EXISTS idx_jobs_status
+                 ON jobs (status, run_after, id)''')
+
+
+def _now(offset=0):
+    return (datetime.utcnow() + timedelta(seconds=offset)).strftime(TIME_FORMAT)
+
+
+def enqueue(c, kind, payload=None, created_by=None, max_attempts=None, delay=0):
+    if kind not in handlers:
+        raise JobError('نوع مهمة غير معروف: ' + kind)
+    max_attempts = Config.JOB_MAX_ATTEMPTS if max_attempts is None else max_attempts
+    return database.insert(c, '''INSERT INTO jobs (kind, payload, max_attempts, run_after, created_by)
+                                 VALUES (?, ?, ?, ?, ?)''',
+                           (kind, json.dumps(payload or {}), max_attempts, _now(delay), created_by))
+
+
+def get_job(conn, job_id):
+    return database.query_one(conn, '''SELECT id, kind, status, attempts, max_attempts, progress, message,
+                                       result, error, created_by, created_at, started_at, finished_at
+                                       FROM jobs WHERE id = ?''', (job_id,))
+
+
+def recent_jobs(conn, limit=50):
+    return database.query_all(conn, '''SELECT id, kind, status, attempts, progress, message, error,
+                                       created_at, finished_at
+                                       FROM jobs ORDER BY id DESC LIMIT ?''', (limit,))
+
+
+# حجز المهمة التالية: مهمة في الانتظار حان وقتها، أو مهمة انتهت مهلة حجزها (عامل توقف)
+# الحجز بتحديث مشروط حتى لا يأخذ عاملان نفس المهمة
+def lease(conn, worker, seconds=None):
+    seconds = Config.JOB_LEASE_SECONDS if seconds is None else seconds
+    while True:
+        now = _now()
+        candidate = database.query_one(conn, '''SELECT id, attempts, max_attempts FROM jobs
+                                                WHERE (status = 'queued' AND run_after <= ?)
+                                                OR (status = 'running' AND lease_until < ?)
+                                                ORDER BY id LIMIT 1''', (now, now))
+        if candidate is None:
+            return None
+
+        if candidate.attempts >= candidate.max_attempts:
+            # توقف العامل أثناء المحاولة الأخيرة
+            conn.execute('''UPDATE jobs SET status = 'failed', finished_at = ?,
+                            error = COALESCE(error, 'انتهت مهلة الحجز')
+                            WHERE id = ? AND status = 'running' AND lease_until < ?''',
+                         (now, candidate.id, now))
+            conn.commit()
+            continue
+
+        c = conn.cursor()
+        c.execute('''UPDATE jobs SET status = 'running', worker = ?, lease_until = ?,
+                     attempts = attempts + 1, started_at = ?
+                     WHERE id = ? AND attempts = ?
+                     AND ((status = 'queued' AND run_after <= ?) OR (status = 'running' AND lease_until < ?))''',
+                  (worker, _now(seconds), now, candidate.id, candidate.attempts, now, now))
+        conn.commit()
+        if c.rowcount == 1:
+            return database.query_one(conn, 'SELECT id, kind, payload, attempts, max_attempts FROM jobs WHERE id = ?',
+                                      (candidate.id,))
+
+
+# آخر موعد يومي مستحق لساعة معينة (UTC)
+def _last_due(hour, now=None):
+    now = now or datetime.utcnow()
+    due = now.replace(hour=hour, minute=0, second=0, microsecond=0)
+    if due > now:
+        due -= timedelta(days=1)
+    return due.strftime(TIME_FORMAT)
+
+
+# إضافة المهام اليومية التي لم تُضف منذ آخر موعد لها؛ الإدراج مشروط حتى لا تتكرر مع أكثر من عامل
+def enqueue_daily(conn):
+    for kind, hour in daily.items():
+        if hour < 0:
+            continue
+        due = _last_due(hour)
+        conn.execute('''INSERT INTO jobs (kind, payload, max_attempts, run_after)
+                        SELECT ?, '{}', ?, ?
+                        WHERE NOT EXISTS (SELECT 1 FROM jobs WHERE kind = ? AND run_after >= ?)''',
+                     (kind, Config.JOB_MAX_ATTEMPTS, _now(), kind, due))
+    conn.commit()
+
+
+# تمديد الحجز للمهام الجارية لدى هذا العامل
+def renew(conn, worker, job_ids, seconds=None):
+    if not job_ids:
+        return
+    seconds = Config.JOB_LEASE_SECONDS if seconds is None else seconds
+    conn.execute('''UPDATE jobs SET lease_until = ?
+                    WHERE worker = ? AND status = 'running' AND id IN (%s)''' % ', '.join('?' * len(job_ids)),
+                 [_now(seconds), worker] + list(job_ids))
+    conn.commit()
+
+
+# تقدم المهمة (0 إلى 1) مع رسالة اختيارية، يستدعى من داخل الدالة
+class Progress:
+    def __init__(self, job_id, worker):
+        self.job_id = job_id
+        self.worker = worker
+        self.last = 0
+
+    def __call__(self, fraction, message=None, force=False):
+        # كتابة واحدة في الثانية على الأكثر
+        now = time.monotonic()
+        if not force and now - self.last < 1:
+            return
+        self.last = now
+        conn = database.connect()
+        try:
+            conn.execute('''UPDATE jobs SET progress = ?, message = COALESCE(?, message)
+                            WHERE id = ? AND worker = ?''',
+                         (max(0.0, min(1.0, float(fraction))), message, self.job_id, self.worker))
+            conn.commit()
+        finally:
+            conn.close()
+
+
+def _finish(job_id, worker, result):
+    conn = database.connect()
+    try:
+        conn.execute('''UPDATE jobs SET status = 'done', progress = 1, result = ?, error = NULL,
+                        lease_until = NULL, finished_at = ?
+                        WHERE id = ? AND worker = ?''',
+                     (json.dumps(result, default=str), _now(), job_id, worker))
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def _fail(job_id, worker, attempts, max_attempts, error):
+    conn = database.connect()
+    try:
+        if attempts < max_attempts:
+            # إعادة المحاولة بعد مهلة تتضاعف مع كل محاولة
+            delay = Config.JOB_RETRY_DELAY * 2 ** (attempts - 1)
+            conn.execute('''UPDATE jobs SET status = 'queued', run_after = ?, lease_until = NULL, error = ?
+                            WHERE id = ? AND worker = ?''',
+                         (_now(delay), error, job_id, worker))
+        else:
+            conn.execute('''UPDATE jobs SET status = 'failed', lease_until = NULL, error = ?, finished_at = ?
+                            WHERE id = ? AND worker = ?''',
+                         (error, _now(), job_id, worker))
+        conn.commit()
+    finally:
+        conn.close()
+
+
+# تنفيذ مهمة واحدة داخل عملية من المجمع
+def execute(job_id, kind, payload, attempts, max_attempts, worker):
+    progress = Progress(job_id, worker)
+    try:
+        result = handlers[kind](json.loads(payload or '{}'), progress)
+    except Exception:
+        _fail(job_id, worker, attempts, max_attempts, traceback.format_exc(limit=5))
+        return False
+    _finish(job_id, worker, result)
+    return True
+
+
+# العامل: يحجز المهام ويوزعها على مجمع عمليات، ويمدد حجز المهام الجارية
+def run_worker(processes=None, poll_interval=None):
+    processes = processes or Config.JOB_WORKERS
+    poll_interval = Config.JOB_POLL_INTERVAL if poll_interval is None else poll_interval
+    worker = '%s:%d' % (socket.gethostname(), os.getpid())
+    running = {}
+    stopping = []
+
+    def stop(signum, frame):
+        stopping.append(signum)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    conn = database.connect()
+    last_renew = time.monotonic()
+    last_daily = None
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        while not stopping or running:
+            for job_id, future in list(running.items()):
+                if future.done():
+                    del running[job_id]
+
+            job = None
+            try:
+                if time.monotonic() - last_renew > Config.JOB_LEASE_SECONDS / 3.0:
+                    renew(conn, worker, running.keys())
+                    last_renew = time.monotonic()
+
+                # فحص المهام اليومية مرة في الدقيقة
+                if last_daily is None or time.monotonic() - last_daily > 60:
+                    enqueue_daily(conn)
+                    last_daily = time.monotonic()
+
+                if not stopping and len(running) < processes:
+                    job = lease(conn, worker)
+            except database.Error:
+                # القاعدة مقفلة أو لم تُنشأ جداولها بعد (العامل يبدأ مع الموقع): المحاولة في الدورة التالية
+                conn.rollback()
+            if job is None:
+                time.sleep(poll_interval)
+                continue
+
+            running[job.id] = pool.submit(execute, job.id, job.kind, job.payload,
+                                          job.attempts, job.max_attempts, worker)
+    conn.close()
+
+
+# المهام الثقيلة المتاحة
+@handler('rebuild_stats')
+def rebuild_stats(payload, progress):
+    import gradebook
+    progress(0, 'إعادة حساب إحصائيات الواجبات', force=True)
+    conn = database.connect()
+    try:
+        gradebook.rebuild_all_stats(conn, progress)
+    finally:
+        conn.close()
+    return {}
+
+
+@handler('backup')
+def create_backup(payload, progress):
+    import backup
+    progress(0, 'إنشاء نسخة احتياطية', force=True)
+    return {'path': backup.create_snapshot(report=progress)}
+
+
+# المهام اليومية: النوع -> ساعة التشغيل (UTC)
+daily = {'backup': Config.BACKUP_HOUR}
+
+
+@handler('index_similarity')
+def index_similarity(payload, progress):
+    import similarity
+    progress(0, 'فهرسة الحلول لكشف التشابه', force=True)
+    conn = database.connect()
+    try:
+        count = similarity.index_missing(conn, payload.get('assignment_id'), progress)
+    finally:
+        conn.close()
+    return {'indexed': count}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='قائمة المهام في الخلفية')
+    sub = parser.add_subparsers(dest='command', required=True)
+    worker = sub.add_parser('worker', help='تشغيل العامل')
+    worker.add_argument('--processes', type=int, default=None)
+    enqueue_parser = sub.add_parser('enqueue', help='إضافة مهمة')
+    enqueue_parser.add_argument('kind', choices=sorted(handlers))
+    enqueue_parser.add_argument('payload', nargs='?', default='{}')
+    sub.add_parser('list', help='عرض آخر المهام')
+    args = parser.parse_args(argv)
+
+    if args.command == 'worker':
+        run_worker(args.processes)
+    elif args.command == 'enqueue':
+        conn = database.connect()
+        c = conn.cursor()
+        print(enqueue(c, args.kind, json.loads(args.payload)))
+        conn.commit()
+        conn.close()
+    elif args.command == 'list':
+        conn = database.connect()
+        for job in recent_jobs(conn):
+            print(job.id, job.kind, job.status, job.attempts, job.progress, job.message or '')
+        conn.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,120 @@
+﻿import os
+import math
+import time
+import threading
+from datetime import datetime
+from functools import wraps
+
+from flask import request, session
+
+from config import Config
+from fastjson import jsonify
+
+
+# دلو رموز لكل جلسة: سعة للدفعات القصيرة ومعدل تعبئة ثابت
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.buckets = {}
+        self.lock = threading.Lock()
+        # الدلو يمتلئ بعد هذه المدة دون طلبات، فلا فرق بين حذفه وإبقائه
+        self.full_after = capacity / rate
+        self.last_prune = 0.0
+
+    # يرجع 0 إذا سمح بالطلب، وإلا عدد الثواني حتى يتوفر رمز
+    def take(self, key, now=None):
+        now = now or time.monotonic()
+        with self.lock:
+            # الحذف الدوري في كل المسارات: القاموس لا يحوي إلا جلسات طلبت خلال آخر مدتين من full_after
+            if now - self.last_prune > self.full_after:
+                self._prune(now)
+            tokens, last = self.buckets.get(key, (self.capacity, now))
+            tokens = min(self.capacity, tokens + (now - last) * self.rate)
+            if tokens >= 1:
+                self.buckets[key] = (tokens - 1, now)
+                return 0
+            self.buckets[key] = (tokens, now)
+            return (1 - tokens) / self.rate
+
+    def _prune(self, now):
+        # حذف الجلسات التي امتلأ دلوها (لم تطلب منذ مدة)
+        for key, (tokens, last) in list(self.buckets.items()):
+            if now - last > self.full_after:
+                del self.buckets[key]
+        self.last_prune = now
+
+
+bucket = TokenBucket(Config.POLL_RATE, Config.POLL_BURST)
+
+_in_flight = 0
+_in_flight_lock = threading.Lock()
+
+
+def request_started():
+    global _in_flight
+    with _in_flight_lock:
+        _in_flight += 1
+
+
+def request_finished():
+    global _in_flight
+    with _in_flight_lock:
+        _in_flight = max(0, _in_flight - 1)
+
+
+# تقدير حمل الخادم: 1.0 يعني أن العامل أو المعالج مشغول بالكامل
+def load_factor():
+    load = _in_flight / float(Config.POLL_WORKER_CAPACITY)
+    try:
+        load = max(load, os.getloadavg()[0] / (os.cpu_count() or 1))
+    except (AttributeError, OSError):
+        pass
+    return load
+
+
+def seconds_since(timestamp):
+    # أوقات قاعدة البيانات بتوقيت UTC بصيغة CURRENT_TIMESTAMP
+    if not timestamp:
+        return None
+    try:
+        then = datetime.strptime(str(timestamp)[:19], '%Y-%m-%d %H:%M:%S')
+    except ValueError:
+        return None
+    return max(0, (datetime.utcnow() - then).total_seconds())
+
+
+# الفترة المقترحة للاستطلاع التالي بحسب نشاط الغرفة وحمل الخادم
+def next_poll_ms(base_ms, idle_seconds=None):
+    interval = float(base_ms)
+    if idle_seconds is not None and idle_seconds > 60:
+        # غرفة هادئة: إبطاء تدريجي حتى 8 أضعاف
+        interval *= min(8.0, idle_seconds / 60.0)
+    load = load_factor()
+    if load > 0.5:
+        interval *= 1 + (load - 0.5) * 4
+    return int(min(max(interval, base_ms), Config.POLL_MAX_MS))
+
+
+def _retry_response(status, seconds, error):
+    seconds = max(1, int(math.ceil(seconds)))
+    response = jsonify({'success': False, 'error': error, 'retry_after': seconds})
+    response.status_code = status
+    response.headers['Retry-After'] = str(seconds)
+    return response
+
+
+# لواجهات الاستطلاع فقط: رفض مبكر عند الضغط حتى لا تتأثر تسجيلات الدخول والتسليمات
+def polling_endpoint(view):
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if load_factor() >= Config.POLL_SHED_LOAD:
+            return _retry_response(503, Config.POLL_MAX_MS / 1000.0, 'الخادم مشغول، حاول لاحقاً')
+
+        key = session.get('user_id') or request.remote_addr
+        wait = bucket.take(key)
+        if wait:
+            return _retry_response(429, wait, 'طلبات كثيرة، حاول لاحقاً')
+
+        return view(*args, **kwargs)
+    return wrapper
@@ -0,0 +1,90 @@
+﻿import os
+import time
+import threading
+from collections import OrderedDict
+
+from jinja2 import FileSystemBytecodeCache, nodes
+from jinja2.ext import Extension
+
+import cache
+from config import Config
+
+
+# الأجزاء المعروضة من القوالب: المفتاح يشمل إصدار كل كيان تعتمد عليه،
+# فأي تغيير في الكيان (من أي عامل عبر سجل التغييرات) ينتج مفتاحاً جديداً
+class FragmentCache:
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get_or_render(self, key, render):
+        with self.lock:
+            value = self.items.get(key)
+            if value is not None:
+                self.items.move_to_end(key)
+                return value
+        value = render()
+        with self.lock:
+            self.items[key] = value
+            while len(self.items) > self.max_size:
+                self.items.popitem(last=False)
+        return value
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+
+
+fragments = FragmentCache(Config.FRAGMENT_CACHE_SIZE)
+
+
+# {% fragment 'name', [('user', session.user_id), ('class', grade ~ '/' ~ section)] %} ... {% endfragment %}
+class FragmentCacheExtension(Extension):
+    tags = {'fragment'}
+
+    def __init__(self, environment):
+        super().__init__(environment)
+        # التخزين يعمل في وضع الإنتاج فقط حتى تظهر تعديلات القوالب مباشرة أثناء التطوير
+        environment.extend(fragment_caching=False)
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        args = [parser.parse_expression()]
+        parser.stream.expect('comma')
+        args.append(parser.parse_expression())
+        body = parser.parse_statements(['name:endfragment'], drop_needle=True)
+        return nodes.CallBlock(self.call_method('_render', args), [], [], body).set_lineno(lineno)
+
+    def _render(self, name, dependencies, caller):
+        if not self.environment.fragment_caching:
+            return caller()
+        key = (name,) + tuple((entity, str(entity_id), cache.entities.version(entity, entity_id))
+                              for entity, entity_id in dependencies)
+        return fragments.get_or_render(key, caller)
+
+
+# تحميل كل القوالب عند التشغيل؛ الترجمة تحفظ على القرص فلا تتكرر بعد إعادة التشغيل
+def precompile(app):
+    started = time.time()
+    names = app.jinja_env.list_templates(extensions=['html'])
+    for name in names:
+        app.jinja_env.get_template(name)
+    return len(names), time.time() - started
+
+
+def configure(app):
+    app.jinja_options = dict(app.jinja_options)
+    app.jinja_options['extensions'] = list(app.jinja_options.get('extensions', [])) + [FragmentCacheExtension]
+
+    if Config.TEMPLATE_MODE != 'production':
+        app.config['TEMPLATES_AUTO_RELOAD'] = True
+        return
+
+    # الإنتاج: بدون فحص تعديل الملفات مع كل طلب
+    app.config['TEMPLATES_AUTO_RELOAD'] = False
+    if not os.path.exists(Config.TEMPLATE_CACHE_FOLDER):
+        os.makedirs(Config.TEMPLATE_CACHE_FOLDER)
+    app.jinja_options['bytecode_cache'] = FileSystemBytecodeCache(Config.TEMPLATE_CACHE_FOLDER)
+    app.jinja_env.fragment_caching = True
+    precompile(app)
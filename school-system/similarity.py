@@ -0,0 +1,259 @@
+﻿import re
+import sys
+import time
+import zlib
+import random
+import hashlib
+import sqlite3
+import argparse
+from itertools import combinations, groupby
+
+import database
+import submissions
+
+# التوقيع: 128 دالة تجزئة مقسمة إلى 32 شريحة × 4 صفوف
+# الزوج يصبح مرشحاً إذا تطابقت شريحة واحدة على الأقل (احتمال الالتقاط ~97% عند تشابه 0.55)
+NUM_PERM = 128
+BANDS = 32
+ROWS = NUM_PERM // BANDS
+
+SHINGLE_SIZE = 3
+MIN_SHINGLES = 5
+THRESHOLD = 0.4
+MAX_PAIRS = 100
+
+# أقنعة XOR ثابتة بدلاً من التباديل حتى تبقى التواقيع المخزنة صالحة بعد إعادة التشغيل
+_MASKS = [random.Random(20240101 + i).getrandbits(64) for i in range(NUM_PERM)]
+
+_DIACRITICS = re.compile('[ؐ-ًؚ-ٰٟۖ-ۭـ]')
+_NON_WORD = re.compile(r'[^\w]+')
+_LETTERS = str.maketrans({
+    'أ': 'ا', 'إ': 'ا', 'آ': 'ا', 'ٱ': 'ا',
+    'ى': 'ي', 'ئ': 'ي', 'ؤ': 'و', 'ة': 'ه',
+    '٠': '0', '١': '1', '٢': '2', '٣': '3', '٤': '4',
+    '٥': '5', '٦': '6', '٧': '7', '٨': '8', '٩': '9',
+})
+
+
+def init_similarity_tables(c):
+    c.execute('''CREATE TABLE IF NOT EXISTS submission_signatures
+                 (submission_id INTEGER PRIMARY KEY,
+                  assignment_id INTEGER NOT NULL,
+                  signature TEXT)''')
+
+    # صف لكل شريحة من التوقيع؛ الحلول في نفس الدلو مرشحة للتشابه
+    c.execute('''CREATE TABLE IF NOT EXISTS submission_lsh
+                 (assignment_id INTEGER NOT NULL,
+                  band INTEGER NOT NULL,
+                  bucket INTEGER NOT NULL,
+                  submission_id INTEGER NOT NULL)''')
+
+    # فهرس مغطٍّ: البحث عن الدلاء المشتركة لا يقرأ الجدول نفسه
+    c.execute('''CREATE INDEX IF NOT EXISTS idx_submission_lsh_bucket
+                 ON submission_lsh (assignment_id, band, bucket, submission_id)''')
+
+
+# توحيد الكتابة العربية: حذف التشكيل والتطويل، توحيد الألف والياء والتاء المربوطة والأرقام
+def normalize(text):
+    text = _DIACRITICS.sub('', text or '').translate(_LETTERS).lower()
+    return _NON_WORD.sub(' ', text).replace('_', ' ').split()
+
+
+def shingles(text):
+    words = normalize(text)
+    if len(words) >= SHINGLE_SIZE + MIN_SHINGLES:
+        grams = {' '.join(words[i:i + SHINGLE_SIZE]) for i in range(len(words) - SHINGLE_SIZE + 1)}
+    else:
+        # نص قصير: مقاطع من الحروف بدلاً من الكلمات
+        joined = ' '.join(words)
+        grams = {joined[i:i + 5] for i in range(len(joined) - 4)}
+    return [int.from_bytes(hashlib.blake2b(gram.encode('utf-8'), digest_size=8).digest(), 'big')
+            for gram in grams]
+
+
+def signature(hashes):
+    if len(hashes) < MIN_SHINGLES:
+        return None
+    return [min(map(mask.__xor__, hashes)) for mask in _MASKS]
+
+
+def bands(sig):
+    return [zlib.crc32(','.join(map(str, sig[band * ROWS:(band + 1) * ROWS])).encode()) & 0x7fffffff
+            for band in range(BANDS)]
+
+
+def estimate(sig_a, sig_b):
+    return sum(1 for x, y in zip(sig_a, sig_b) if x == y) / float(NUM_PERM)
+
+
+# فهرسة حل واحد عند التسليم (ضمن معاملة التسليم)
+def index_submission(c, submission_id, assignment_id, text):
+    sig = signature(shingles(text))
+    c.execute('''INSERT INTO submission_signatures (submission_id, assignment_id, signature)
+                 VALUES (?, ?, ?) ON CONFLICT (submission_id) DO NOTHING''',
+              (submission_id, assignment_id, ','.join(map(str, sig)) if sig else None))
+    if sig:
+        c.executemany('INSERT INTO submission_lsh (assignment_id, band, bucket, submission_id) VALUES (?, ?, ?, ?)',
+                      [(assignment_id, band, bucket, submission_id) for band, bucket in enumerate(bands(sig))])
+
+
+# فهرسة الحلول القديمة التي سُلمت قبل إضافة الفهرس
+def index_missing(conn, assignment_id=None, progress=None):
+    query = '''SELECT s.id, s.assignment_id, s.solution, b.encoding, b.body FROM assignment_submissions s
+               LEFT JOIN submission_signatures sg ON sg.submission_id = s.id
+               LEFT JOIN submission_bodies b ON b.submission_id = s.id
+               WHERE sg.submission_id IS NULL'''
+    params = []
+    if assignment_id is not None:
+        query += ' AND s.assignment_id = ?'
+        params.append(assignment_id)
+    rows = conn.execute(query, params).fetchall()
+    c = conn.cursor()
+    for done, (submission_id, submission_assignment, solution, encoding, body) in enumerate(rows, 1):
+        index_submission(c, submission_id, submission_assignment, submissions.full_text(solution, encoding, body))
+        if progress:
+            progress(done / len(rows), 'فهرسة الحلول لكشف التشابه')
+    conn.commit()
+    return len(rows)
+
+
+# الدلاء التي تحوي أكثر من حل واحد فقط؛ كل زوج فيها مرشح للمقارنة
+def candidate_pairs(conn, assignment_id):
+    rows = conn.execute('''SELECT l.band, l.bucket, l.submission_id FROM submission_lsh l
+                           JOIN (SELECT band, bucket FROM submission_lsh WHERE assignment_id = ?
+                                 GROUP BY band, bucket HAVING COUNT(*) > 1) shared
+                             ON shared.band = l.band AND shared.bucket = l.bucket
+                           WHERE l.assignment_id = ?
+                           ORDER BY l.band, l.bucket, l.submission_id''',
+                        (assignment_id, assignment_id)).fetchall()
+    pairs = set()
+    for _, members in groupby(rows, key=lambda row: (row[0], row[1])):
+        pairs.update(combinations([row[2] for row in members], 2))
+    return pairs
+
+
+def _signatures(conn, ids, chunk=500):
+    ids = sorted(ids)
+    result = {}
+    for start in range(0, len(ids), chunk):
+        part = ids[start:start + chunk]
+        for submission_id, sig in conn.execute('''SELECT submission_id, signature FROM submission_signatures
+                                                  WHERE submission_id IN (%s)''' % ', '.join('?' * len(part)),
+                                               part):
+            result[submission_id] = [int(x) for x in sig.split(',')]
+    return result
+
+
+# الأزواج المتشابهة في واجب: المرشحون من الدلاء المشتركة فقط ثم تقدير التشابه من التواقيع
+def similar_pairs(conn, assignment_id, threshold=THRESHOLD, limit=MAX_PAIRS):
+    candidates = candidate_pairs(conn, assignment_id)
+    if not candidates:
+        return []
+    signatures = _signatures(conn, {submission_id for pair in candidates for submission_id in pair})
+    pairs = []
+    for first, second in candidates:
+        score = estimate(signatures[first], signatures[second])
+        if score >= threshold:
+            pairs.append((score, first, second))
+    pairs.sort(key=lambda pair: (-pair[0], pair[1], pair[2]))
+    return pairs[:limit]
+
+
+# الأزواج مع أسماء الطلاب للعرض
+def similar_pairs_report(conn, assignment_id):
+    pairs = similar_pairs(conn, assignment_id)
+    if not pairs:
+        return []
+    ids = sorted({submission_id for _, first, second in pairs for submission_id in (first, second)})
+    names = {row.id: row.student_name for row in database.query_all(
+        conn, '''SELECT s.id, u.name as student_name FROM assignment_submissions s
+                 JOIN users u ON u.id = s.student_id
+                 WHERE s.id IN (%s)''' % ', '.join('?' * len(ids)), ids)}
+    return [{'first_id': first, 'second_id': second,
+             'first_name': names.get(first), 'second_name': names.get(second),
+             'similarity': round(score * 100)}
+            for score, first, second in pairs]
+
+
+# قياس الأداء: حلول عشوائية مع نسخ مزروعة، لإظهار أن الزمن يكبر خطياً تقريباً
+_WORDS = ('الطالب المعلم الدرس الكتاب المدرسة العلم الرياضيات الفيزياء الكيمياء التاريخ '
+          'الجغرافيا اللغة الأدب الشعر النثر القاعدة المعادلة التجربة النتيجة الفرضية '
+          'البحث السؤال الجواب الفكرة المثال التحليل الاستنتاج المقدمة الخاتمة الفقرة '
+          'يكتب يقرأ يحسب يشرح يفسر يناقش يقارن يستنتج يلاحظ يجرب في من إلى على عن مع '
+          'هذا ذلك التي الذي لأن لكن ثم أو و قد كان يكون جدا كثيرا قليلا أيضا').split()
+
+
+def _essay(rng, length):
+    return ' '.join(rng.choice(_WORDS) for _ in range(length))
+
+
+def _copy_with_edits(rng, text, ratio):
+    words = text.split()
+    for _ in range(int(len(words) * ratio)):
+        words[rng.randrange(len(words))] = rng.choice(_WORDS)
+    return ' '.join(words)
+
+
+def benchmark(sizes=(500, 1000, 2000, 5000), length=150, copies=0.05, seed=1):
+    rng = random.Random(seed)
+    results = []
+    for size in sizes:
+        conn = sqlite3.connect(':memory:')
+        c = conn.cursor()
+        init_similarity_tables(c)
+        texts = []
+        planted = set()
+        for i in range(size):
+            if texts and rng.random() < copies:
+                source = rng.randrange(len(texts))
+                texts.append(_copy_with_edits(rng, texts[source], 0.1))
+                planted.add((source + 1, i + 1))
+            else:
+                texts.append(_essay(rng, length))
+
+        started = time.time()
+        for i, text in enumerate(texts):
+            index_submission(c, i + 1, 1, text)
+        conn.commit()
+        index_seconds = time.time() - started
+
+        started = time.time()
+        pairs = similar_pairs(conn, 1, limit=None)
+        query_seconds = time.time() - started
+
+        found = {(first, second) for _, first, second in pairs}
+        recall = len(planted & found) / float(len(planted)) if planted else 1.0
+        candidates = len(candidate_pairs(conn, 1))
+        conn.close()
+        results.append({'submissions': size, 'all_pairs': size * (size - 1) // 2,
+                        'candidates': candidates, 'index_ms_each': round(index_seconds * 1000 / size, 2),
+                        'query_seconds': round(query_seconds, 3), 'planted': len(planted),
+                        'recall': round(recall, 3)})
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='كشف الحلول المتشابهة')
+    sub = parser.add_subparsers(dest='command', required=True)
+    bench = sub.add_parser('bench', help='قياس الأداء على حلول مولدة')
+    bench.add_argument('--sizes', default='500,1000,2000,5000')
+    bench.add_argument('--length', type=int, default=150)
+    sub.add_parser('index', help='فهرسة الحلول غير المفهرسة')
+    args = parser.parse_args(argv)
+
+    if args.command == 'bench':
+        sizes = [int(size) for size in args.sizes.split(',')]
+        print('submissions  all_pairs  candidates  index_ms_each  query_s  planted  recall')
+        for row in benchmark(sizes, args.length):
+            print('%11d  %9d  %10d  %13.2f  %7.3f  %7d  %6.3f' % (
+                row['submissions'], row['all_pairs'], row['candidates'], row['index_ms_each'],
+                row['query_seconds'], row['planted'], row['recall']))
+    elif args.command == 'index':
+        conn = database.connect()
+        print(index_missing(conn))
+        conn.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,67 @@
+﻿// استطلاع تكيفي: يتبع الفترة التي يقترحها الخادم، ويتباطأ عند الخمول أو إخفاء الصفحة،
+// ويحترم Retry-After عند الرفض (429 / 503)
+function createPoller(url, onData, options = {}) {
+    const minInterval = options.minInterval || 3000;
+    const maxInterval = options.maxInterval || 60000;
+    const hiddenInterval = options.hiddenInterval || 60000;
+    const idleFactor = options.idleFactor || 1.5;
+
+    let interval = minInterval;
+    let timer = null;
+    let inFlight = false;
+
+    function schedule(delay) {
+        clearTimeout(timer);
+        if (document.hidden) {
+            delay = Math.max(delay, hiddenInterval);
+        }
+        timer = setTimeout(poll, delay);
+    }
+
+    function poll() {
+        if (inFlight) {
+            return;
+        }
+        inFlight = true;
+
+        fetch(url)
+            .then(response => {
+                if (response.status === 429 || response.status === 503) {
+                    const retryAfter = parseInt(response.headers.get('Retry-After') || '0', 10) * 1000;
+                    interval = Math.min(maxInterval, Math.max(retryAfter, interval * 2));
+                    return;
+                }
+                return response.json().then(data => {
+                    const hint = data.next_poll_ms || minInterval;
+                    // onData ترجع true إذا كانت هناك بيانات جديدة
+                    const changed = data.success && onData(data);
+                    interval = changed ? hint : Math.min(maxInterval, Math.max(hint, interval * idleFactor));
+                });
+            })
+            .catch(() => {
+                interval = Math.min(maxInterval, interval * 2);
+            })
+            .finally(() => {
+                inFlight = false;
+                schedule(interval);
+            });
+    }
+
+    // عند العودة إلى الصفحة نحدّث فوراً
+    document.addEventListener('visibilitychange', function() {
+        if (!document.hidden) {
+            interval = minInterval;
+            schedule(0);
+        }
+    });
+
+    schedule(interval);
+
+    return {
+        // تحديث فوري (مثلاً بعد إرسال رسالة)
+        refresh: function() {
+            interval = minInterval;
+            schedule(0);
+        }
+    };
+}
@@ -0,0 +1,123 @@
+﻿import sys
+import zlib
+import argparse
+
+import database
+from config import Config
+
+# الحلول الأطول من هذا الحد تُضغط وتُنقل إلى submission_bodies،
+# ويبقى في عمود solution أول PREVIEW_LENGTH حرفاً فقط للعرض في القوائم
+COMPRESS_THRESHOLD = Config.SOLUTION_COMPRESS_THRESHOLD
+PREVIEW_LENGTH = 200
+ZLIB = 'zlib'
+
+# أعمدة القوائم: كل شيء عدا نص الحل الكامل
+SUMMARY_COLUMNS = '''s.id, s.assignment_id, s.student_id, s.grade, s.feedback, s.status,
+                     s.submitted_at, s.graded_at,
+                     substr(s.solution, 1, %d) as preview,
+                     COALESCE(b.size, length(s.solution)) as solution_length''' % PREVIEW_LENGTH
+
+
+def init_submission_tables(c):
+    c.execute('''CREATE TABLE IF NOT EXISTS submission_bodies
+                 (submission_id INTEGER PRIMARY KEY,
+                  encoding TEXT NOT NULL,
+                  size INTEGER NOT NULL,
+                  body BLOB NOT NULL)''')
+
+
+def compress(text):
+    return zlib.compress(text.encode('utf-8'), 6)
+
+
+def decompress(encoding, body):
+    if encoding != ZLIB:
+        raise ValueError('ترميز غير معروف: %s' % encoding)
+    return zlib.decompress(body).decode('utf-8')
+
+
+# النص الكامل من صف فيه solution و encoding و body (من LEFT JOIN على submission_bodies)
+def full_text(solution, encoding, body):
+    if body is None:
+        return solution
+    return decompress(encoding, body)
+
+
+def _store_body(c, submission_id, solution):
+    c.execute('''INSERT INTO submission_bodies (submission_id, encoding, size, body)
+                 VALUES (?, ?, ?, ?)''', (submission_id, ZLIB, len(solution), compress(solution)))
+
+
+# تسليم حل جديد وإرجاع معرفه
+def create(c, assignment_id, student_id, solution):
+    large = len(solution) > COMPRESS_THRESHOLD
+    submission_id = database.insert(c, '''INSERT INTO assignment_submissions (assignment_id, student_id, solution)
+                                          VALUES (?, ?, ?)''',
+                                    (assignment_id, student_id, solution[:PREVIEW_LENGTH] if large else solution))
+    if large:
+        _store_body(c, submission_id, solution)
+    return submission_id
+
+
+# حلول واجب للعرض: الحقول المختصرة ومعاينة فقط
+def list_for_assignment(conn, assignment_id):
+    return database.query_all(conn, '''SELECT %s, u.name as student_name,
+                                       u.grade as student_grade, u.section as student_section
+                                       FROM assignment_submissions s
+                                       JOIN users u ON s.student_id = u.id
+                                       LEFT JOIN submission_bodies b ON b.submission_id = s.id
+                                       WHERE s.assignment_id = ?
+                                       ORDER BY s.submitted_at DESC''' % SUMMARY_COLUMNS, (assignment_id,))
+
+
+# حل واحد مع نصه الكامل، مع بيانات الملكية للتحقق من الصلاحية
+def get(conn, submission_id):
+    row = database.query_one(conn, '''SELECT s.id, s.assignment_id, s.student_id, s.grade, s.feedback,
+                                      s.status, s.submitted_at, s.solution, b.encoding, b.body,
+                                      a.teacher_id, a.title, a.total_marks, u.name as student_name
+                                      FROM assignment_submissions s
+                                      JOIN assignments a ON a.id = s.assignment_id
+                                      JOIN users u ON u.id = s.student_id
+                                      LEFT JOIN submission_bodies b ON b.submission_id = s.id
+                                      WHERE s.id = ?''', (submission_id,))
+    if row is None:
+        return None
+    result = row.as_dict()
+    result['solution'] = full_text(result.pop('solution'), result.pop('encoding'), result.pop('body'))
+    return result
+
+
+# نقل الحلول الطويلة المخزنة قبل الضغط، على دفعات
+def compact(conn, batch=200):
+    moved = 0
+    while True:
+        rows = conn.execute('''SELECT s.id, s.solution FROM assignment_submissions s
+                               LEFT JOIN submission_bodies b ON b.submission_id = s.id
+                               WHERE b.submission_id IS NULL AND length(s.solution) > ?
+                               LIMIT ?''', (COMPRESS_THRESHOLD, batch)).fetchall()
+        if not rows:
+            return moved
+        c = conn.cursor()
+        for submission_id, solution in rows:
+            _store_body(c, submission_id, solution)
+            c.execute('UPDATE assignment_submissions SET solution = ? WHERE id = ?',
+                      (solution[:PREVIEW_LENGTH], submission_id))
+        conn.commit()
+        moved += len(rows)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='تخزين حلول الطلاب')
+    sub = parser.add_subparsers(dest='command', required=True)
+    sub.add_parser('compact', help='ضغط الحلول الطويلة المخزنة سابقاً')
+    args = parser.parse_args(argv)
+
+    if args.command == 'compact':
+        conn = database.connect()
+        print(compact(conn))
+        conn.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,84 @@
+﻿import threading
+from collections import OrderedDict
+
+import database
+from config import Config
+
+
+def init_unread_tables(c):
+    # آخر رسالة قرأها المستخدم في كل غرفة
+    c.execute('''CREATE TABLE IF NOT EXISTS room_read_cursors
+                 (user_id INTEGER NOT NULL,
+                  room_id INTEGER NOT NULL,
+                  last_read_id INTEGER NOT NULL DEFAULT 0,
+                  updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                  PRIMARY KEY (user_id, room_id))''')
+
+    # عدّ الرسائل بعد المؤشر = مسح مدى على هذا الفهرس
+    c.execute('''CREATE INDEX IF NOT EXISTS idx_chat_messages_room
+                 ON chat_messages (room_id, id)''')
+
+
+# عمود عدد الرسائل غير المقروءة لاستعلامات قوائم الغرف (r = rooms)
+# المعاملات: (user_id, user_id)
+UNREAD_COUNT_SQL = '''(SELECT COUNT(*) FROM chat_messages cm
+                       WHERE cm.room_id = r.id AND cm.user_id != ?
+                       AND cm.id > COALESCE((SELECT rc.last_read_id FROM room_read_cursors rc
+                                             WHERE rc.user_id = ? AND rc.room_id = r.id), 0))'''
+
+# آخر مؤشر كتبه هذا العامل، حتى لا يكتب الاستطلاع إلا عند وصول رسائل جديدة
+# محدود الحجم: الأقدم استخداماً يحذف أولاً (أسوأ حالة كتابة واحدة زائدة)
+_written = OrderedDict()
+_lock = threading.Lock()
+
+
+def _remember(key, message_id):
+    with _lock:
+        if _written.get(key, 0) < message_id:
+            _written[key] = message_id
+        _written.move_to_end(key)
+        while len(_written) > Config.UNREAD_MEMO_SIZE:
+            _written.popitem(last=False)
+
+
+def mark_read(conn, user_id, room_id, message_id):
+    if not message_id:
+        return False
+    key = (user_id, room_id)
+    with _lock:
+        if _written.get(key, 0) >= message_id:
+            _written.move_to_end(key)
+            return False
+
+    try:
+        conn.execute('''INSERT INTO room_read_cursors (user_id, room_id, last_read_id, updated_at)
+                        VALUES (?, ?, ?, CURRENT_TIMESTAMP)
+                        ON CONFLICT (user_id, room_id) DO UPDATE SET
+                         last_read_id = CASE WHEN excluded.last_read_id > room_read_cursors.last_read_id
+                                             THEN excluded.last_read_id
+                                             ELSE room_read_cursors.last_read_id END,
+                         updated_at = excluded.updated_at''',
+                     (user_id, room_id, message_id))
+        conn.commit()
+    except database.Error:
+        # القاعدة مشغولة مثلاً: لا يُسجل المؤشر حتى يعاد المحاولة في الاستطلاع التالي
+        conn.rollback()
+        return False
+    _remember(key, message_id)
+    return True
+
+
+# عدد الرسائل غير المقروءة في كل غرف المستخدم بطلب واحد
+def unread_counts(conn, user_id, user_type):
+    if user_type == 'teacher':
+        rows = database.query_all(conn, '''SELECT r.id, %s as unread_count
+                                            FROM rooms r
+                                            WHERE r.teacher_id = ? AND r.is_active = 1''' % UNREAD_COUNT_SQL,
+                                  (user_id, user_id, user_id))
+    else:
+        rows = database.query_all(conn, '''SELECT r.id, %s as unread_count
+                                            FROM rooms r
+                                            JOIN room_students rs ON r.id = rs.room_id
+                                            WHERE rs.student_id = ? AND r.is_active = 1''' % UNREAD_COUNT_SQL,
+                                  (user_id, user_id, user_id))
+    return {row.id: row.unread_count for row in rows}